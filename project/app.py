@@ -1,112 +1,742 @@
 # app.py
 
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify, flash
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, flash, Response, g, make_response, send_file, abort
 import sqlite3
-from werkzeug.security import generate_password_hash, check_password_hash
 import os
+import base64
+import hashlib
+import json
+import queue
+import re
+import threading
+import time
+import atexit
+from collections import OrderedDict
 from datetime import datetime, timedelta
+from markupsafe import Markup
+from migrations import migrate, RATING_SORT_KEY
+from currency import RateProvider, usd_price_update
+from message_archive import archive_chat, ENDED_CHATS_WITH_MESSAGES_QUERY
+from shared_state import SharedCounters, state_file
+from password_hashing import PasswordHasher, HashingBusy
+from product_images import (HASH_PATTERN, IMAGE_DIR, MAX_IMAGE_BYTES, InvalidImage, ThumbnailWorker, image_type,
+                            original_path, store_image, thumbnail_path)
+from metrics import (InstrumentedConnection, RequestMetrics, count_statement, start_query_stats,
+                     stop_query_stats)
 
 app = Flask(__name__)
 app.secret_key = 'your_secret_key'  # Replace with a strong secret key
 
 DATABASE = 'auboutique.db'
+DB_POOL_MAX_IDLE = 8  # Idle connections kept open for reuse
+DB_BUSY_TIMEOUT_MS = 5000  # How long a connection waits on a locked database before failing
+DB_MMAP_SIZE = 256 * 1024 * 1024
+DB_CACHE_SIZE_KB = 16 * 1024
+DB_JOURNAL_SIZE_LIMIT = 64 * 1024 * 1024
+# Statements taking at least this long are logged with their SQL; 0 turns the log off
+SLOW_QUERY_MS = float(os.environ.get('AUBOUTIQUE_SLOW_QUERY_MS', 100))
+PRESENCE_FLUSH_SECONDS = 30  # How often last-seen times are written to users.last_active
+ONLINE_WINDOW = timedelta(minutes=5)  # Users seen within this window count as online
+OFFLINE_LAST_ACTIVE = '1970-01-01 00:00:00'  # users.last_active of a user who logged out
+ONLINE_USERS_CACHE_SECONDS = 5  # How long the /users online list is shared between requests
+PURCHASE_MAX_ATTEMPTS = 5  # Tries to take the write lock for a purchase before giving up
+PURCHASE_RETRY_DELAY_SECONDS = 0.05
+LISTING_CACHE_MAX_ENTRIES = 512  # Marketplace pages kept in memory across all users
+CHAT_ACCESS_CACHE_MAX_ENTRIES = 10000  # Chats whose participants and status are kept in memory
+WISHLIST_CACHE_MAX_ENTRIES = 10000  # Users whose wishlisted product ids are kept in memory
+CHAT_HISTORY_PAGE_SIZE = 50  # Messages shown when a chat opens and per "load older" request
+# How /send_message stores messages:
+#   'direct' - insert and commit on the request thread
+#   'group'  - a writer thread commits messages in groups; the reply waits for the commit
+#   'queued' - as 'group', but the reply is sent as soon as the message is queued
+#              (faster, but messages still queued are lost if the process dies)
+MESSAGE_WRITE_MODE = os.environ.get('AUBOUTIQUE_MESSAGE_WRITE_MODE', 'direct')
+MESSAGE_GROUP_MAX_ROWS = 256  # Most messages committed together
+MESSAGE_GROUP_MAX_DELAY_SECONDS = 0.002  # Longest a message waits for others to join its group
+MESSAGE_COMMIT_TIMEOUT_SECONDS = 10
+STREAM_KEEPALIVE_SECONDS = 15  # Comment line sent on idle chat streams so proxies keep them open
+CHAT_SEND_LOCK_STRIPES = 64  # Locks shared out among chats by id; sends to one chat always share one
+CHAT_RELAY_POLL_SECONDS = 0.05  # With several workers, how often each checks for other workers' messages
+MARKETPLACE_PAGE_SIZE = 50  # Products per marketplace page; clients may ask for up to the max
+MARKETPLACE_MAX_PAGE_SIZE = 200
+# werkzeug hash method for new passwords; raise the cost here and users are rehashed as they log in
+PASSWORD_HASH_METHOD = os.environ.get('AUBOUTIQUE_PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+PASSWORD_HASH_WORKERS = int(os.environ.get('AUBOUTIQUE_PASSWORD_HASH_WORKERS', 0)) or os.cpu_count() or 1
+PASSWORD_HASH_QUEUE_PER_WORKER = 4  # Hashes waiting per worker before logins are turned away
+PASSWORD_HASH_TIMEOUT_SECONDS = 10
+PASSWORD_HASH_RETRY_AFTER_SECONDS = 2
+IMAGE_MAX_AGE_SECONDS = 365 * 24 * 3600  # Image URLs name their content, so browsers may keep them this long
+
+# Sort key expression and direction for each marketplace sort order
+MARKETPLACE_SORTS = {
+    'id': ('products.id', 'ASC'),
+    'newest': ('products.id', 'DESC'),
+    'price_asc': ('products.price_usd', 'ASC'),
+    'price_desc': ('products.price_usd', 'DESC'),
+    'rating': (RATING_SORT_KEY, 'DESC'),
+    'relevance': ('bm25(products_fts)', 'ASC'),
+}
+
+# SQL of the hot paths. checked_queries() hands these same strings to `migrations.py --check`;
+# {placeholders} is filled with one ? per value in the IN list.
+USER_BY_NAME_QUERY = 'SELECT * FROM users WHERE username = ?'
+ONLINE_USERS_QUERY = 'SELECT username, name FROM users WHERE last_active >= ?'
+ONLINE_OR_PENDING_USERS_QUERY = ONLINE_USERS_QUERY + ' OR username IN ({placeholders})'
+PRESENCE_FLUSH_QUERY = '''UPDATE users SET last_active = ?
+                          WHERE username = ? AND (logged_out_at IS NULL OR logged_out_at < ?)'''
+LOGOUT_QUERY = 'UPDATE users SET last_active = ?, logged_out_at = ? WHERE username = ?'
+LOGIN_QUERY = 'UPDATE users SET last_active = ?, password = COALESCE(?, password) WHERE username = ?'
+PURCHASE_QUERY = '''UPDATE products
+                    SET quantity = quantity - 1, sold = (quantity = 1), buyer = ?
+                    WHERE id = ? AND quantity > 0 AND sold = 0 AND seller != ?'''
+PURCHASE_FAILURE_QUERY = 'SELECT seller, sold, quantity FROM products WHERE id = ?'
+RATING_AGGREGATE_QUERY = '''UPDATE products
+                            SET rating_count = rating_count + 1, rating_sum = rating_sum + ?
+                            WHERE id = ?'''
+WISHLIST_IDS_QUERY = 'SELECT product_id FROM wishlist WHERE user_username = ?'
+WISHLIST_PRODUCTS_QUERY = '''SELECT products.*, CAST(rating_sum AS REAL) / NULLIF(rating_count, 0) AS avg_rating
+                             FROM wishlist JOIN products ON products.id = wishlist.product_id
+                             WHERE wishlist.user_username = ?
+                             ORDER BY wishlist.id DESC'''
+CHAT_BY_ID_QUERY = 'SELECT id, user1, user2, status FROM chats WHERE id = ?'
+ACTIVE_CHAT_BETWEEN_QUERY = '''SELECT chats.id FROM chats
+                               WHERE ((user1 = ? AND user2 = ?) OR (user1 = ? AND user2 = ?))
+                               AND status = "active"'''
+PENDING_REQUEST_QUERY = '''SELECT * FROM chat_requests
+                           WHERE from_user = ? AND to_user = ? AND status = "pending"'''
+INCOMING_REQUESTS_QUERY = 'SELECT * FROM chat_requests WHERE to_user = ? AND status = "pending"'
+USER_CHAT_IDS_QUERY = 'SELECT chat_id FROM user_chats WHERE username = ?'
+ACTIVE_CHATS_QUERY = '''SELECT user_chats.chat_id AS id, user_chats.other_user, user_chats.unread_count,
+                               messages.content AS last_message
+                        FROM user_chats LEFT JOIN messages ON messages.id = user_chats.last_message_id
+                        WHERE user_chats.username = ?
+                        ORDER BY COALESCE(user_chats.last_message_id, 0) DESC'''
+END_CHATS_QUERY = 'UPDATE chats SET status = "ended" WHERE id IN ({placeholders})'
+DELETE_USER_CHATS_QUERY = 'DELETE FROM user_chats WHERE chat_id IN ({placeholders})'
+RECORD_MESSAGE_QUERY = '''UPDATE user_chats
+                          SET last_message_id = ?,
+                              unread_count = CASE WHEN username = ? THEN 0 ELSE unread_count + 1 END,
+                              last_read_id = CASE WHEN username = ? THEN ? ELSE last_read_id END
+                          WHERE chat_id = ?'''
+MARK_READ_QUERY = '''UPDATE user_chats SET last_read_id = ?,
+                     unread_count = (SELECT COUNT(*) FROM messages WHERE chat_id = ? AND id > ? AND sender != ?)
+                     WHERE username = ? AND chat_id = ? AND last_read_id < ?'''
+UNREAD_COUNTS_QUERY = '''SELECT (SELECT COALESCE(SUM(unread_count), 0) FROM user_chats WHERE username = ?)
+                                    AS unread_messages,
+                                (SELECT COUNT(*) FROM chat_requests WHERE to_user = ? AND status = 'pending')
+                                    AS chat_requests'''
+MESSAGES_AFTER_QUERY = '''SELECT id, sender, content, timestamp FROM messages
+                          WHERE chat_id = ? AND id > ?
+                          ORDER BY id ASC'''
+LATEST_MESSAGES_QUERY = '''SELECT id, sender, content, timestamp FROM messages
+                           WHERE chat_id = ?
+                           ORDER BY id DESC LIMIT ?'''
+MESSAGES_BEFORE_QUERY = '''SELECT id, sender, content, timestamp FROM messages
+                           WHERE chat_id = ? AND id < ?
+                           ORDER BY id DESC LIMIT ?'''
+RELAY_MESSAGES_QUERY = 'SELECT id, chat_id, sender, content, timestamp FROM messages WHERE id > ? ORDER BY id'
+RELAY_ENDED_CHATS_QUERY = "SELECT id FROM chats WHERE status = 'ended' AND id IN ({placeholders})"
+
+rate_provider = RateProvider()
+
+password_hasher = PasswordHasher(PASSWORD_HASH_METHOD, PASSWORD_HASH_WORKERS,
+                                 PASSWORD_HASH_WORKERS * PASSWORD_HASH_QUEUE_PER_WORKER,
+                                 PASSWORD_HASH_TIMEOUT_SECONDS)
+atexit.register(password_hasher.shutdown)
+
+@rate_provider.on_reload
+def refresh_price_usd(rates):
+    # price_usd backs price sorting and filtering in SQL; recompute it off the request thread
+    def refresh():
+        update_price_usd(rates)
+        listing_cache.invalidate()
+
+    # Displayed prices change straight away; price order once price_usd is recomputed
+    listing_cache.invalidate()
+    threading.Thread(target=refresh, name='price-usd-refresh', daemon=True).start()
+
+@app.context_processor
+def inject_currencies():
+    return {"currencies": rate_provider.currencies()}
+
+def update_price_usd(rates):
+    conn = connect_database()
+    try:
+        conn.execute(*usd_price_update(rates))
+        conn.commit()
+    finally:
+        conn.close()
 
 def init_database():
-    if not os.path.exists(DATABASE):
-        conn = sqlite3.connect(DATABASE)
-        c = conn.cursor()
+    # Creates the database on first run and applies any pending schema migrations
+    migrate(DATABASE)
+    # The rates file may have changed while the app was down; only later changes trigger a reload
+    update_price_usd(rate_provider.rates())
 
-        # Create users table
-        c.execute('''CREATE TABLE IF NOT EXISTS users
-                    (username TEXT PRIMARY KEY,
-                     password TEXT NOT NULL,
-                     name TEXT NOT NULL,
-                     email TEXT NOT NULL,
-                     last_active DATETIME DEFAULT CURRENT_TIMESTAMP)''')
-
-        # Create products table
-        c.execute('''CREATE TABLE IF NOT EXISTS products
-                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                     name TEXT NOT NULL,
-                     description TEXT NOT NULL,
-                     price REAL NOT NULL,
-                     currency TEXT NOT NULL,
-                     image TEXT,
-                     seller TEXT NOT NULL,
-                     buyer TEXT,
-                     sold BOOLEAN DEFAULT 0,
-                     quantity INTEGER DEFAULT 1,
-                     category TEXT,
-                     FOREIGN KEY (seller) REFERENCES users(username))''')
-
-        # Create ratings table
-        c.execute('''CREATE TABLE IF NOT EXISTS ratings
-                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                     product_id INTEGER,
-                     rating INTEGER,
-                     FOREIGN KEY (product_id) REFERENCES products(id))''')
-
-        # Create chat_requests table
-        c.execute('''CREATE TABLE IF NOT EXISTS chat_requests
-                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                     from_user TEXT NOT NULL,
-                     to_user TEXT NOT NULL,
-                     status TEXT DEFAULT 'pending',
-                     timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                     FOREIGN KEY (from_user) REFERENCES users(username),
-                     FOREIGN KEY (to_user) REFERENCES users(username))''')
-
-        # Create chats table
-        c.execute('''CREATE TABLE IF NOT EXISTS chats
-                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                     user1 TEXT NOT NULL,
-                     user2 TEXT NOT NULL,
-                     status TEXT DEFAULT 'active',
-                     FOREIGN KEY (user1) REFERENCES users(username),
-                     FOREIGN KEY (user2) REFERENCES users(username))''')
-
-        # Create messages table
-        c.execute('''CREATE TABLE IF NOT EXISTS messages
-                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                     chat_id INTEGER NOT NULL,
-                     sender TEXT NOT NULL,
-                     content TEXT NOT NULL,
-                     timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                     FOREIGN KEY (chat_id) REFERENCES chats(id),
-                     FOREIGN KEY (sender) REFERENCES users(username))''')
-
-        # Create wishlist table
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS wishlist (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_username TEXT NOT NULL,
-                product_id INTEGER NOT NULL,
-                added_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_username) REFERENCES users(username),
-                FOREIGN KEY (product_id) REFERENCES products(id),
-                UNIQUE(user_username, product_id)
-            )
-        ''')
+def connect_database():
+    conn = sqlite3.connect(DATABASE, check_same_thread=False, factory=InstrumentedConnection)
+    conn.row_factory = sqlite3.Row
+    # WAL lets readers proceed while a writer commits; NORMAL sync is safe under WAL
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute(f'PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}')
+    conn.execute('PRAGMA foreign_keys = ON')
+    conn.execute(f'PRAGMA mmap_size = {DB_MMAP_SIZE}')
+    conn.execute(f'PRAGMA cache_size = -{DB_CACHE_SIZE_KB}')
+    # Readers in other worker processes can hold back checkpoints; trim the WAL once they finish
+    conn.execute(f'PRAGMA journal_size_limit = {DB_JOURNAL_SIZE_LIMIT}')
+    # Statements from here on count against the current request for /metrics
+    conn.set_trace_callback(count_statement)
+    conn.slow_query_seconds = SLOW_QUERY_MS / 1000 if SLOW_QUERY_MS > 0 else None
+    return conn
 
-        conn.commit()
-        conn.close()
-        print("[DB] Database initialized with all tables, including wishlist.")
-    else:
-        print("[DB] Database already exists.")
+class ConnectionPool:
+    """Keeps idle SQLite connections around so requests don't reopen the database."""
+
+    def __init__(self, max_idle):
+        self._idle = queue.LifoQueue(maxsize=max_idle)
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return connect_database()
+
+    def release(self, conn):
+        # Never hand a half-finished transaction to the next request
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+db_pool = ConnectionPool(DB_POOL_MAX_IDLE)
 
 def get_db_connection():
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
-    return conn
+    # One pooled connection per request, shared by before_request hooks and the view
+    if 'db' not in g:
+        g.db = db_pool.acquire()
+    return g.db
+
+@app.teardown_appcontext
+def release_db_connection(exception):
+    conn = g.pop('db', None)
+    if conn is not None:
+        db_pool.release(conn)
+
+request_metrics = RequestMetrics()
+
+@app.before_request
+def start_request_metrics():
+    # Registered before the other hooks so their queries count towards the request too
+    g.request_started = time.perf_counter()
+    g.query_stats, g.query_stats_token = start_query_stats()
+
+@app.after_request
+def record_request_metrics(response):
+    if 'request_started' in g:
+        stop_query_stats(g.pop('query_stats_token'))
+        endpoint = g.pop('metrics_endpoint', None) or request.endpoint or 'unmatched'
+        request_metrics.observe(endpoint, response.status_code,
+                                time.perf_counter() - g.pop('request_started'), g.pop('query_stats'))
+    return response
+
+class ChatBroker:
+    """In-process fan-out of new chat messages to open /stream_messages listeners."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._listeners = {}
+
+    def subscribe(self, chat_id, listener=None):
+        # A listener is anything with put(); a plain queue unless the caller brings its own
+        if listener is None:
+            listener = queue.Queue()
+        with self._lock:
+            self._listeners.setdefault(chat_id, set()).add(listener)
+        return listener
+
+    def unsubscribe(self, chat_id, listener):
+        with self._lock:
+            listeners = self._listeners.get(chat_id)
+            if listeners:
+                listeners.discard(listener)
+                if not listeners:
+                    del self._listeners[chat_id]
+
+    def publish(self, chat_id, message):
+        with self._lock:
+            listeners = list(self._listeners.get(chat_id, ()))
+        for listener in listeners:
+            listener.put(message)
+
+    def close(self, chat_id):
+        # None tells every open stream for this chat that it has ended
+        self.publish(chat_id, None)
+
+class SharedChatBroker(ChatBroker):
+    """Chat broker for multi-worker serving, where a message may be sent to another process.
+
+    publish() and close() only bump a shared counter. A relay thread in every worker then
+    reads new messages and ended chats from the database and hands them to its own listeners,
+    in id order.
+    """
+
+    def __init__(self, counters, poll_interval):
+        super().__init__()
+        self.counters = counters
+        self.poll_interval = poll_interval
+        self._relay_lock = threading.Lock()
+        self._relay = None
+
+    def subscribe(self, chat_id, listener=None):
+        self._start_relay()
+        return super().subscribe(chat_id, listener)
+
+    def publish(self, chat_id, message):
+        self.counters.bump('chat_events')
+
+    def close(self, chat_id):
+        self.counters.bump('chat_events')
+
+    def _start_relay(self):
+        with self._relay_lock:
+            if self._relay is not None:
+                return
+            # Find the starting point before the first stream reads its backlog, so no
+            # message falls between the two
+            conn = connect_database()
+            seen_events = self.counters.get('chat_events')
+            last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM messages').fetchone()[0]
+            self._relay = threading.Thread(target=self._run, args=(conn, seen_events, last_id),
+                                           name='chat-relay', daemon=True)
+            self._relay.start()
+
+    def _run(self, conn, seen_events, last_id):
+        while True:
+            time.sleep(self.poll_interval)
+            events = self.counters.get('chat_events')
+            if events == seen_events:
+                continue
+            seen_events = events
+            try:
+                last_id = self._relay_events(conn, last_id)
+            except sqlite3.Error as e:
+                print(f"[Chat] Relay failed: {e}")
+
+    def _relay_events(self, conn, last_id):
+        with self._lock:
+            chat_ids = set(self._listeners)
+        for row in conn.execute(RELAY_MESSAGES_QUERY, (last_id,)).fetchall():
+            last_id = row['id']
+            if row['chat_id'] in chat_ids:
+                message = dict(row)
+                del message['chat_id']
+                ChatBroker.publish(self, row['chat_id'], message)
+        if chat_ids:
+            placeholders = ', '.join('?' * len(chat_ids))
+            for row in conn.execute(RELAY_ENDED_CHATS_QUERY.format(placeholders=placeholders), list(chat_ids)):
+                ChatBroker.publish(self, row['id'], None)
+        return last_id
+
+chat_broker = ChatBroker()
+
+class PendingMessage:
+    def __init__(self, chat_id, sender, content, timestamp):
+        self.chat_id = chat_id
+        self.sender = sender
+        self.content = content
+        self.timestamp = timestamp
+        self.id = None
+        self.error = None
+        self.committed = threading.Event()
+
+class MessageWriter:
+    """Single writer thread that inserts queued chat messages and commits them in groups."""
+
+    def __init__(self, max_rows, max_delay):
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._worker = None
+
+    def submit(self, chat_id, sender, content, timestamp):
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name='message-writer', daemon=True)
+                self._worker.start()
+        message = PendingMessage(chat_id, sender, content, timestamp)
+        self._queue.put(message)
+        return message
+
+    def drain(self, timeout):
+        # Commit whatever is still queued; used at exit
+        if self._worker is not None:
+            marker = PendingMessage(None, None, None, None)
+            self._queue.put(marker)
+            marker.committed.wait(timeout)
+
+    def _run(self):
+        conn = connect_database()
+        while True:
+            group = [self._queue.get()]
+            deadline = time.monotonic() + self.max_delay
+            while len(group) < self.max_rows:
+                # Take everything already waiting, then linger briefly for stragglers
+                try:
+                    group.append(self._queue.get_nowait())
+                    continue
+                except queue.Empty:
+                    pass
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    group.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._commit(conn, [message for message in group if message.chat_id is not None])
+            for message in group:
+                message.committed.set()
+
+    def _commit(self, conn, group):
+        if not group:
+            return
+        try:
+            c = conn.cursor()
+            for message in group:
+                c.execute('''INSERT INTO messages (chat_id, sender, content, timestamp)
+                             VALUES (?, ?, ?, ?)''',
+                          (message.chat_id, message.sender, message.content, message.timestamp))
+                message.id = c.lastrowid
+                record_chat_message(c, message.chat_id, message.sender, message.id)
+            # One commit (and one fsync) for the whole group
+            conn.commit()
+        except sqlite3.Error as e:
+            conn.rollback()
+            print(f"[Messages] Group commit of {len(group)} messages failed: {e}")
+            for message in group:
+                message.error = e
+            return
+        for message in group:
+            chat_broker.publish(message.chat_id, {
+                "id": message.id,
+                "sender": message.sender,
+                "content": message.content,
+                "timestamp": message.timestamp
+            })
+
+message_writer = MessageWriter(MESSAGE_GROUP_MAX_ROWS, MESSAGE_GROUP_MAX_DELAY_SECONDS)
+atexit.register(message_writer.drain, MESSAGE_COMMIT_TIMEOUT_SECONDS)
+
+class MessageArchiver:
+    """Archives the messages of ended chats on a background thread."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._worker = None
+
+    def schedule(self, chat_ids):
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name='message-archiver', daemon=True)
+                self._worker.start()
+        for chat_id in chat_ids:
+            self._queue.put(chat_id)
+
+    def _run(self):
+        conn = connect_database()
+        conn.isolation_level = None  # archive_chat manages its own transaction
+        while True:
+            chat_id = self._queue.get()
+            try:
+                archive_chat(conn, chat_id)
+            except sqlite3.Error as e:
+                print(f"[Archive] Could not archive chat {chat_id}: {e}")
+
+message_archiver = MessageArchiver()
+thumbnail_worker = ThumbnailWorker(IMAGE_DIR)
+
+class PresenceTracker:
+    """Buffers when users were last seen in memory and writes them to users.last_active in batches."""
+
+    def __init__(self, flush_interval):
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._flusher = None
+
+    def touch(self, username):
+        with self._lock:
+            self._pending[username] = datetime.utcnow()
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._run, name='presence-flush', daemon=True)
+                self._flusher.start()
+
+    def forget(self, username):
+        with self._lock:
+            self._pending.pop(username, None)
+
+    def pending_since(self, since):
+        # Users seen since then whose visit this process hasn't written yet
+        with self._lock:
+            return [username for username, seen in self._pending.items() if seen >= since]
+
+    def flush(self):
+        with self._lock:
+            batch = [(seen.strftime('%Y-%m-%d %H:%M:%S'), username, seen.strftime('%Y-%m-%d %H:%M:%S'))
+                     for username, seen in self._pending.items()]
+            self._pending.clear()
+        if not batch:
+            return
+        conn = connect_database()
+        try:
+            # Visits from before the user's last logout, possibly through another worker, don't
+            # bring them back online; later ones from another of their sessions do
+            conn.executemany(PRESENCE_FLUSH_QUERY, batch)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                print(f"[Presence] Flush failed: {e}")
+
+presence = PresenceTracker(PRESENCE_FLUSH_SECONDS)
+atexit.register(presence.flush)
+
+_online_users_cache = {"expires": 0, "users": []}
+_online_users_lock = threading.Lock()
+
+def get_online_users():
+    # Every /users view within the TTL shares one list instead of querying again
+    with _online_users_lock:
+        if time.monotonic() < _online_users_cache["expires"]:
+            return _online_users_cache["users"]
+
+    # The database has every visit flushed by any worker; add this one's unwritten visits
+    threshold = datetime.utcnow() - ONLINE_WINDOW
+    pending = presence.pending_since(threshold)
+    query = ONLINE_USERS_QUERY
+    if pending:
+        query = ONLINE_OR_PENDING_USERS_QUERY.format(placeholders=', '.join('?' * len(pending)))
+    conn = get_db_connection()
+    c = conn.cursor()
+    # Sorted here: ORDER BY would make SQLite walk the username index instead of using both
+    c.execute(query, [threshold.strftime('%Y-%m-%d %H:%M:%S')] + pending)
+    online_users = sorted((dict(row) for row in c.fetchall()), key=lambda user: user['username'])
+
+    with _online_users_lock:
+        _online_users_cache["users"] = online_users
+        _online_users_cache["expires"] = time.monotonic() + ONLINE_USERS_CACHE_SECONDS
+    return online_users
+
+class ListingCache:
+    """Bounded LRU of rendered marketplace pages, invalidated by bumping the catalog version."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.version = 0
+        self.modified = datetime.utcnow().replace(microsecond=0)
+        self.counters = None
+
+    def share(self, counters):
+        # Follow a catalog version kept in counters shared with other worker processes
+        with self._lock:
+            if not counters.get('listing_modified'):
+                counters.set('listing_modified', int(time.time()))
+            self.counters = counters
+            self.version = None
+            self._sync()
+
+    def _sync(self):
+        # Drop pages if another worker changed the catalog since this one last looked
+        if self.counters is None:
+            return
+        version = self.counters.get('listing')
+        if version != self.version:
+            self.version = version
+            self.modified = datetime.utcfromtimestamp(self.counters.get('listing_modified'))
+            self._entries.clear()
+
+    def current_version(self):
+        with self._lock:
+            self._sync()
+            return self.version
+
+    def get(self, key):
+        with self._lock:
+            self._sync()
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry, version):
+        with self._lock:
+            self._sync()
+            # Drop pages built from data that changed while they were being built
+            if version != self.version:
+                return
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self):
+        with self._lock:
+            if self.counters is None:
+                self.version += 1
+                self.modified = datetime.utcnow().replace(microsecond=0)
+            else:
+                self.counters.set('listing_modified', int(time.time()))
+                self.version = self.counters.bump('listing')
+                self.modified = datetime.utcfromtimestamp(self.counters.get('listing_modified'))
+            self._entries.clear()
+
+listing_cache = ListingCache(LISTING_CACHE_MAX_ENTRIES)
+
+class GenerationCache:
+    """Bounded LRU of rows that rarely change, so hot paths skip the query that loads them.
+
+    Invalidation moves a generation number; with several workers it lives in the shared
+    counter named by `counter`.
+    """
+
+    def __init__(self, max_entries, counter):
+        self.max_entries = max_entries
+        self.counter = counter
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._generation = 0
+        self.counters = None
+        self.hits = 0
+        self.misses = 0
+
+    def share(self, counters):
+        # Follow a generation kept in counters shared with other worker processes
+        with self._lock:
+            self.counters = counters
+            self._generation = counters.get(self.counter)
+            self._entries.clear()
+
+    def _sync(self):
+        if self.counters is None:
+            return
+        generation = self.counters.get(self.counter)
+        if generation != self._generation:
+            # Another worker changed an entry; which one isn't known, so start over
+            self._generation = generation
+            self._entries.clear()
+
+    def get(self, key):
+        # Returns (value, generation); pass the generation back to put() after a miss
+        with self._lock:
+            self._sync()
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return value, self._generation
+
+    def put(self, key, value, generation):
+        with self._lock:
+            self._sync()
+            # A value read before an invalidation may already be stale
+            if generation != self._generation:
+                return
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, keys):
+        with self._lock:
+            if self.counters is None:
+                self._generation += 1
+                for key in keys:
+                    self._entries.pop(key, None)
+            else:
+                # Every worker, this one included, starts over when the shared generation moves
+                self._generation = self.counters.bump(self.counter)
+                self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+# Each chat's participants and status, so message polling doesn't query chats
+chat_access_cache = GenerationCache(CHAT_ACCESS_CACHE_MAX_ENTRIES, 'chats')
+request_metrics.expose('auboutique_chat_access_cache_hits_total', "Chat access checks answered from memory.",
+                       lambda: chat_access_cache.hits, 'counter')
+request_metrics.expose('auboutique_chat_access_cache_misses_total', "Chat access checks that read the chats table.",
+                       lambda: chat_access_cache.misses, 'counter')
+# Product ids on each user's wishlist, so the marketplace can mark them without a query
+wishlist_cache = GenerationCache(WISHLIST_CACHE_MAX_ENTRIES, 'wishlists')
+
+def enable_shared_state(path):
+    # Called by the multi-worker launcher before it forks: caches and chat streams then
+    # follow changes made in any worker through counters in the shared state file
+    global chat_broker
+    counters = SharedCounters(path)
+    listing_cache.share(counters)
+    chat_access_cache.share(counters)
+    wishlist_cache.share(counters)
+    chat_broker = SharedChatBroker(counters, CHAT_RELAY_POLL_SECONDS)
+
+def share_listing_version():
+    # A single-process server follows the catalog version in the state file too, so tools such
+    # as bulk_products.py can tell it to drop cached listing pages
+    listing_cache.share(SharedCounters(state_file(DATABASE)))
+
+def get_chat(chat_id):
+    # Participants and status of a chat, or None if it doesn't exist
+    chat, generation = chat_access_cache.get(chat_id)
+    if chat is None:
+        chat = load_chat(get_db_connection(), chat_id, generation)
+    return chat
+
+def load_chat(conn, chat_id, generation):
+    row = conn.execute(CHAT_BY_ID_QUERY, (chat_id,)).fetchone()
+    if not row:
+        return None
+    chat = dict(row)
+    chat_access_cache.put(chat_id, chat, generation)
+    return chat
+
+def get_active_chat(chat_id, username):
+    # The chat if it is active and username takes part in it, otherwise None
+    chat = get_chat(chat_id)
+    return chat if can_use_chat(chat, username) else None
+
+def can_use_chat(chat, username):
+    return bool(chat) and chat['status'] == 'active' and username in (chat['user1'], chat['user2'])
+
+def get_wishlist_ids(username):
+    # Ids of the products on the user's wishlist
+    product_ids, generation = wishlist_cache.get(username)
+    if product_ids is None:
+        rows = get_db_connection().execute(WISHLIST_IDS_QUERY, (username,)).fetchall()
+        product_ids = frozenset(row['product_id'] for row in rows)
+        wishlist_cache.put(username, product_ids, generation)
+    return product_ids
 
 @app.before_request
 def update_last_active():
+    # Recorded in memory only; the tracker flushes to the database every few seconds
     if 'username' in session:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute('UPDATE users SET last_active = CURRENT_TIMESTAMP WHERE username = ?', (session['username'],))
-        conn.commit()
-        conn.close()
+        presence.touch(session['username'])
 
 @app.route('/')
 def home():
@@ -126,7 +756,10 @@ def register():
             flash("Please fill in all fields.", "danger")
             return render_template('register.html')
 
-        hashed_password = generate_password_hash(password)
+        try:
+            hashed_password = password_hasher.hash(password)
+        except HashingBusy:
+            return hashing_busy('register.html')
 
         conn = get_db_connection()
         c = conn.cursor()
@@ -139,8 +772,6 @@ def register():
         except sqlite3.IntegrityError:
             flash("Username already exists.", "danger")
             return render_template('register.html')
-        finally:
-            conn.close()
 
     return render_template('register.html')
 
@@ -156,12 +787,19 @@ def login():
 
         conn = get_db_connection()
         c = conn.cursor()
-        c.execute('SELECT * FROM users WHERE username = ?', (username,))
+        c.execute(USER_BY_NAME_QUERY, (username,))
         user = c.fetchone()
-        conn.close()
 
-        if user and check_password_hash(user['password'], password):
+        try:
+            matches, new_hash = password_hasher.verify(user['password'], password) if user else (False, None)
+        except HashingBusy:
+            return hashing_busy('login.html')
+
+        if matches:
             session['username'] = username
+            # Written straight away: presence flushes never bring a logged-out user back online
+            c.execute(LOGIN_QUERY, (datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'), new_hash, username))
+            conn.commit()
             flash("Login successful!", "success")
             return redirect(url_for('marketplace'))
         else:
@@ -170,18 +808,34 @@ def login():
 
     return render_template('login.html')
 
+def hashing_busy(template):
+    # Turned away quickly rather than queued behind a burst of logins
+    flash("Too many sign-ins at the moment. Please try again in a few seconds.", "warning")
+    response = make_response(render_template(template), 503)
+    response.headers['Retry-After'] = str(PASSWORD_HASH_RETRY_AFTER_SECONDS)
+    return response
+
 @app.route('/logout')
 def logout():
     if 'username' in session:
         username = session['username']
         conn = get_db_connection()
         c = conn.cursor()
+        c.execute(USER_CHAT_IDS_QUERY, (username,))
+        ended_chat_ids = [row['chat_id'] for row in c.fetchall()]
         # End all active chats involving the user
-        c.execute('UPDATE chats SET status = "ended" WHERE user1 = ? OR user2 = ?', (username, username))
+        if ended_chat_ids:
+            placeholders = ', '.join('?' * len(ended_chat_ids))
+            c.execute(END_CHATS_QUERY.format(placeholders=placeholders), ended_chat_ids)
+            c.execute(DELETE_USER_CHATS_QUERY.format(placeholders=placeholders), ended_chat_ids)
         # Set last_active to a past time to indicate offline
-        c.execute('UPDATE users SET last_active = "1970-01-01 00:00:00" WHERE username = ?', (username,))
+        presence.forget(username)
+        c.execute(LOGOUT_QUERY, (OFFLINE_LAST_ACTIVE, datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'), username))
         conn.commit()
-        conn.close()
+        chat_access_cache.invalidate(ended_chat_ids)
+        for chat_id in ended_chat_ids:
+            chat_broker.close(chat_id)
+        message_archiver.schedule(ended_chat_ids)
         session.pop('username', None)
         flash("Logged out and all active chats ended.", "info")
     return redirect(url_for('login'))
@@ -193,30 +847,207 @@ def marketplace():
 
     currency = request.args.get('currency', 'USD')
     search_query = request.args.get('search', '')
+    sort = request.args.get('sort', '')
+    filters = get_listing_filters()
+
+    # Pending flash messages make this render one-off, so don't let the browser reuse it
+    cacheable = '_flashes' not in session
+    listing, version = get_listing(currency, search_query, sort, filters, None, get_page_size())
+    # Rows are shared by every user; the page marks this user's wishlisted products client-side
+    wishlist_ids = sorted(get_wishlist_ids(session['username']))
+    response = make_response(render_template('marketplace.html', rows_html=Markup(listing['html']),
+                                             currency=currency, search=search_query, sort=listing['sort'],
+                                             filters=filters, category_counts=listing['category_counts'],
+                                             next_cursor=listing['next_cursor'], wishlist_ids=wishlist_ids))
+    if not cacheable:
+        return response
+    return make_listing_conditional(response, version, wishlist_ids)
+
+@app.route('/marketplace/page', methods=['GET'])
+def marketplace_page():
+    if 'username' not in session:
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
 
-    conn = get_db_connection()
-    c = conn.cursor()
-
+    currency = request.args.get('currency', 'USD')
+    search_query = request.args.get('search', '')
+    sort = request.args.get('sort', '')
+    cursor = request.args.get('cursor')
+    filters = get_listing_filters()
+
+    listing, version = get_listing(currency, search_query, sort, filters, cursor, get_page_size())
+    response = jsonify({
+        "status": "success",
+        "products": listing['products'],
+        "html": listing['html'],
+        "sort": listing['sort'],
+        "category_counts": listing['category_counts'],
+        "next_cursor": listing['next_cursor']
+    })
+    return make_listing_conditional(response, version)
+
+def get_listing(currency, search_query, sort, filters, cursor, page_size):
+    # Listing pages are the same for every user, so they are shared until the catalog changes
     if search_query:
-        c.execute('''SELECT * FROM products 
-                     WHERE sold = 0 
-                     AND (name LIKE ? OR description LIKE ? OR category LIKE ?)''',
-                  (f'%{search_query}%', f'%{search_query}%', f'%{search_query}%'))
-    else:
-        c.execute('SELECT * FROM products WHERE sold = 0')
+        # Searches cost far more than browsing; report them under their own endpoint
+        g.metrics_endpoint = request.endpoint + '_search'
+    key = (currency, search_query, sort, tuple(sorted(filters.items())), cursor, page_size)
+    version = listing_cache.current_version()
+    listing = listing_cache.get(key)
+    if listing is None:
+        conn = get_db_connection()
+        c = conn.cursor()
+        # Filter prices are entered in the viewer's currency; the database compares in USD
+        usd_filters = dict(filters)
+        for bound in ('min_price', 'max_price'):
+            if filters[bound] is not None:
+                usd_filters[bound] = convert_currency(filters[bound], currency, 'USD')
+
+        products, sort, next_cursor = fetch_marketplace_page(c, search_query, sort, usd_filters, cursor, page_size)
+        product_list = build_product_list(products, currency)
+        listing = {
+            "products": product_list,
+            "html": render_template('_product_rows.html', products=product_list),
+            "sort": sort,
+            # Only the first page shows the category filter
+            "category_counts": fetch_category_counts(c, search_query, usd_filters) if cursor is None else None,
+            "next_cursor": next_cursor
+        }
+        listing_cache.put(key, listing, version)
+    return listing, version
+
+def make_listing_conditional(response, version, wishlist_ids=()):
+    # The page also shows who is logged in and their wishlist, so the ETag is per user as well
+    # as per catalog version
+    etag_source = f"{version}|{session['username']}|{request.full_path}|{','.join(map(str, wishlist_ids))}"
+    response.set_etag(hashlib.sha1(etag_source.encode()).hexdigest())
+    response.last_modified = listing_cache.modified
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
+def get_page_size():
+    page_size = request.args.get('limit', MARKETPLACE_PAGE_SIZE, type=int)
+    return max(1, min(page_size, MARKETPLACE_MAX_PAGE_SIZE))
+
+def get_listing_filters():
+    # Malformed numbers are ignored rather than rejected
+    return {
+        "category": request.args.get('category', '').strip() or None,
+        "min_price": request.args.get('min_price', type=float),
+        "max_price": request.args.get('max_price', type=float),
+        "min_rating": request.args.get('min_rating', type=float)
+    }
 
+def build_listing_query(search_query, filters, include_category=True):
+    fts_query = build_fts_query(search_query)
+    if fts_query:
+        # Prefix match every search term through the full-text index
+        source = 'products_fts JOIN products ON products.id = products_fts.rowid'
+        conditions = ['products_fts MATCH ?', 'products.sold = 0']
+        params = [fts_query]
+    else:
+        source = 'products'
+        conditions = ['products.sold = 0']
+        params = []
+        if search_query:
+            conditions.append('(products.name LIKE ? OR products.description LIKE ? OR products.category LIKE ?)')
+            params += [f'%{search_query}%'] * 3
+
+    if include_category and filters['category']:
+        conditions.append('products.category = ?')
+        params.append(filters['category'])
+    if filters['min_price'] is not None:
+        conditions.append('products.price_usd >= ?')
+        params.append(filters['min_price'])
+    if filters['max_price'] is not None:
+        conditions.append('products.price_usd <= ?')
+        params.append(filters['max_price'])
+    if filters['min_rating'] is not None:
+        conditions.append(f'{RATING_SORT_KEY} >= ?')
+        params.append(filters['min_rating'])
+
+    return fts_query, source, conditions, params
+
+def build_marketplace_page_query(search_query, sort, filters, cursor, page_size):
+    # Returns the page's SQL, its parameters and the sort order actually used
+    fts_query, source, conditions, params = build_listing_query(search_query, filters)
+    if sort not in MARKETPLACE_SORTS or (sort == 'relevance' and not fts_query):
+        sort = 'relevance' if fts_query else 'id'
+    sort_key, direction = MARKETPLACE_SORTS[sort]
+
+    # Keyset pagination: continue strictly after the last (sort key, id) already sent
+    after = decode_cursor(cursor, sort)
+    if after:
+        comparison = '>' if direction == 'ASC' else '<'
+        conditions.append(f'({sort_key}, products.id) {comparison} (?, ?)')
+        params += after
+
+    # Average rating comes from the aggregate columns kept up to date by rate_product
+    query = f'''SELECT products.*, CAST(rating_sum AS REAL) / NULLIF(rating_count, 0) AS avg_rating,
+                       {sort_key} AS sort_key
+                FROM {source}
+                WHERE {' AND '.join(conditions)}
+                ORDER BY {sort_key} {direction}, products.id {direction}
+                LIMIT ?'''
+    return query, params + [page_size + 1], sort
+
+def fetch_marketplace_page(c, search_query, sort, filters, cursor, page_size):
+    query, params, sort = build_marketplace_page_query(search_query, sort, filters, cursor, page_size)
+    c.execute(query, params)
     products = c.fetchall()
 
+    next_cursor = None
+    if len(products) > page_size:
+        products = products[:page_size]
+        last = products[-1]
+        next_cursor = encode_cursor(sort, last['sort_key'], last['id'])
+
+    return products, sort, next_cursor
+
+def build_category_counts_query(search_query, filters):
+    # Counts honour every filter except the category itself, so users can switch between them
+    _, source, conditions, params = build_listing_query(search_query, filters, include_category=False)
+    query = f'''SELECT products.category AS category, COUNT(*) AS count
+                FROM {source}
+                WHERE {' AND '.join(conditions)}
+                GROUP BY products.category
+                ORDER BY products.category'''
+    return query, params
+
+def fetch_category_counts(c, search_query, filters):
+    c.execute(*build_category_counts_query(search_query, filters))
+    return [dict(row) for row in c.fetchall() if row['category']]
+
+def encode_cursor(sort, sort_value, product_id):
+    payload = json.dumps([sort, sort_value, product_id]).encode()
+    return base64.urlsafe_b64encode(payload).decode()
+
+def decode_cursor(cursor, sort):
+    if not cursor:
+        return None
+    try:
+        cursor_sort, sort_value, product_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        return None
+    # A cursor from a different sort order can't be continued; start from the top
+    if cursor_sort != sort:
+        return None
+    # Only values SQLite can bind; anything else is a tampered cursor
+    if not isinstance(sort_value, (int, float, str, type(None))) or isinstance(sort_value, bool):
+        return None
+    if not isinstance(product_id, int) or isinstance(product_id, bool):
+        return None
+    return [sort_value, product_id]
+
+def build_product_list(products, currency):
+    # Convert the whole page of prices in one pass
+    converted_prices = rate_provider.convert_many(((p['price'], p['currency']) for p in products), currency)
+
     product_list = []
-    for p in products:
+    for p, converted_price in zip(products, converted_prices):
         product_id = p['id']
-        c.execute('SELECT AVG(rating) as avg_rating FROM ratings WHERE product_id = ?', (product_id,))
-        avg_rating = c.fetchone()['avg_rating']
+        avg_rating = p['avg_rating']
         avg_rating = round(avg_rating, 2) if avg_rating else "No ratings"
 
-        # Currency conversion
-        converted_price = convert_currency(p['price'], p['currency'], currency)
-
         product_list.append({
             "id": product_id,
             "name": p['name'],
@@ -226,11 +1057,10 @@ def marketplace():
             "seller": p['seller'],
             "quantity": p['quantity'],
             "category": p['category'],
-            "average_rating": avg_rating
+            "average_rating": avg_rating,
+            "thumbnail_url": url_for('product_thumbnail', image_hash=p['image_hash']) if p['image_hash'] else None
         })
-
-    conn.close()
-    return render_template('marketplace.html', products=product_list, currency=currency, search=search_query)
+    return product_list
 
 @app.route('/add_product', methods=['GET', 'POST'])
 def add_product():
@@ -245,40 +1075,88 @@ def add_product():
         quantity = request.form['quantity']
         category = request.form['category'].strip()
         description = request.form['description'].strip()
-        image = request.form.get('image', '')  # For simplicity, handling image as a URL or base64 string
+        upload = request.files.get('image')
 
-        if not name or not price or not category or not description:
-            flash("Please fill in all required fields.", "danger")
+        price, quantity, error = validate_product(name, price, quantity, category, description)
+        if error:
+            flash(error, "danger")
             return render_template('add_product.html')
 
-        try:
-            price = float(price)
-            quantity = int(quantity)
-            if price <= 0 or quantity <= 0:
-                flash("Price and quantity must be greater than 0.", "danger")
+        # Only the image's hash goes in the database; the file is kept on disk under it
+        image_hash = None
+        if upload and upload.filename:
+            try:
+                image_hash = store_image(upload.read(MAX_IMAGE_BYTES + 1))
+            except InvalidImage as e:
+                flash(str(e), "danger")
                 return render_template('add_product.html')
-        except ValueError:
-            flash("Invalid price or quantity format.", "danger")
-            return render_template('add_product.html')
 
         conn = get_db_connection()
         c = conn.cursor()
         try:
             c.execute('''INSERT INTO products 
-                         (name, description, price, currency, image, seller, quantity, category, sold)
-                         VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0)''',
-                      (name, description, price, currency, image, session['username'], quantity, category))
+                         (name, description, price, currency, image_hash, seller, quantity, category, sold, price_usd)
+                         VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0, ?)''',
+                      (name, description, price, currency, image_hash, session['username'], quantity, category,
+                       convert_currency(price, currency, 'USD')))
             conn.commit()
+            listing_cache.invalidate()
+            if image_hash:
+                thumbnail_worker.schedule(image_hash)
             flash("Product added successfully.", "success")
             return redirect(url_for('marketplace'))
         except sqlite3.Error as e:
             flash(str(e), "danger")
             return render_template('add_product.html')
-        finally:
-            conn.close()
 
     return render_template('add_product.html')
 
+@app.route('/images/<image_hash>')
+def product_image(image_hash):
+    if not HASH_PATTERN.fullmatch(image_hash):
+        abort(404)
+    return send_image(original_path(image_hash), image_hash)
+
+@app.route('/images/<image_hash>/thumbnail')
+def product_thumbnail(image_hash):
+    if not HASH_PATTERN.fullmatch(image_hash):
+        abort(404)
+    path = thumbnail_path(image_hash)
+    if not os.path.exists(path):
+        if not os.path.exists(original_path(image_hash)):
+            abort(404)
+        # Not made yet (or Pillow isn't installed): show the original until it is
+        thumbnail_worker.schedule(image_hash)
+        response = redirect(url_for('product_image', image_hash=image_hash))
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    return send_image(path, image_hash + '-thumbnail')
+
+def send_image(path, etag):
+    # The URL names the content, so the response never changes and browsers need not revalidate
+    try:
+        with open(path, 'rb') as f:
+            mimetype = image_type(f.read(16)) or 'application/octet-stream'
+    except FileNotFoundError:
+        abort(404)
+    response = send_file(os.path.abspath(path), mimetype=mimetype, conditional=True, etag=etag,
+                         max_age=IMAGE_MAX_AGE_SECONDS)
+    response.cache_control.immutable = True
+    return response
+
+def validate_product(name, price, quantity, category, description):
+    # Shared with bulk_products.py; returns the parsed price and quantity, or an error message
+    if not name or not price or not category or not description:
+        return None, None, "Please fill in all required fields."
+    try:
+        price = float(price)
+        quantity = int(quantity)
+    except (TypeError, ValueError):
+        return None, None, "Invalid price or quantity format."
+    if price <= 0 or quantity <= 0:
+        return None, None, "Price and quantity must be greater than 0."
+    return price, quantity, None
+
 @app.route('/buy_product/<int:product_id>', methods=['POST'])
 def buy_product(product_id):
     if 'username' not in session:
@@ -287,48 +1165,56 @@ def buy_product(product_id):
 
     buyer = session['username']
     conn = get_db_connection()
-    c = conn.cursor()
     try:
-        c.execute('SELECT seller, sold, quantity FROM products WHERE id = ?', (product_id,))
-        result = c.fetchone()
-
-        if not result:
-            flash("Product not found.", "danger")
-            return redirect(url_for('marketplace'))
-
-        seller, sold, quantity = result['seller'], result['sold'], result['quantity']
+        result = purchase_product(conn, product_id, buyer)
+    except sqlite3.Error as e:
+        flash(f"Database error: {str(e)}", "danger")
+        return redirect(url_for('marketplace'))
 
-        if sold or quantity <= 0:
-            flash("Product is not available.", "danger")
-            return redirect(url_for('marketplace'))
+    if result == 'purchased':
+        flash("Purchase successful! Check your email for collection details.", "success")
+    elif result == 'not_found':
+        flash("Product not found.", "danger")
+    elif result == 'own_product':
+        flash("Cannot buy your own product.", "danger")
+    else:
+        flash("Product is not available.", "danger")
 
-        if seller == buyer:
-            flash("Cannot buy your own product.", "danger")
-            return redirect(url_for('marketplace'))
+    return redirect(url_for('marketplace'))
 
-        new_quantity = quantity - 1
-        if new_quantity == 0:
-            c.execute('''UPDATE products 
-                         SET sold = 1, buyer = ?, quantity = ?
-                         WHERE id = ?''',
-                      (buyer, new_quantity, product_id))
-        else:
-            c.execute('''UPDATE products 
-                         SET buyer = ?, quantity = ?
-                         WHERE id = ?''',
-                      (buyer, new_quantity, product_id))
+def purchase_product(conn, product_id, buyer):
+    # Take the write lock up front and decrement in a single conditional UPDATE,
+    # so concurrent buyers can never oversell. Retries if the lock stays busy.
+    for attempt in range(PURCHASE_MAX_ATTEMPTS):
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            break
+        except sqlite3.OperationalError as e:
+            if e.sqlite_errorcode != sqlite3.SQLITE_BUSY or attempt == PURCHASE_MAX_ATTEMPTS - 1:
+                raise
+            time.sleep(PURCHASE_RETRY_DELAY_SECONDS * (attempt + 1))
 
-        if c.rowcount > 0:
+    try:
+        c = conn.cursor()
+        c.execute(PURCHASE_QUERY, (buyer, product_id, buyer))
+        if c.rowcount == 1:
             conn.commit()
-            flash("Purchase successful! Check your email for collection details.", "success")
-        else:
-            flash("Product no longer available.", "danger")
-    except sqlite3.Error as e:
-        flash(f"Database error: {str(e)}", "danger")
-    finally:
-        conn.close()
+            listing_cache.invalidate()
+            return 'purchased'
 
-    return redirect(url_for('marketplace'))
+        # Nothing changed; work out why for the message
+        c.execute(PURCHASE_FAILURE_QUERY, (product_id,))
+        product = c.fetchone()
+        conn.rollback()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+
+    if not product:
+        return 'not_found'
+    if product['sold'] or product['quantity'] <= 0:
+        return 'unavailable'
+    return 'own_product'
 
 @app.route('/rate_product/<int:product_id>', methods=['POST'])
 def rate_product(product_id):
@@ -361,12 +1247,12 @@ def rate_product(product_id):
             return redirect(url_for('marketplace'))
 
         c.execute('INSERT INTO ratings (product_id, rating) VALUES (?, ?)', (product_id, rating))
+        c.execute(RATING_AGGREGATE_QUERY, (rating, product_id))
         conn.commit()
+        listing_cache.invalidate()
         flash("Rating submitted successfully.", "success")
     except sqlite3.Error as e:
         flash(f"Database error: {str(e)}", "danger")
-    finally:
-        conn.close()
 
     return redirect(url_for('marketplace'))
 
@@ -392,11 +1278,10 @@ def add_to_wishlist(product_id):
         
         c.execute('INSERT INTO wishlist (user_username, product_id) VALUES (?, ?)', (username, product_id))
         conn.commit()
+        wishlist_cache.invalidate([username])
         flash("Product added to your wishlist.", "success")
     except sqlite3.IntegrityError:
         flash("Product is already in your wishlist.", "info")
-    finally:
-        conn.close()
     
     return redirect(url_for('marketplace'))
 
@@ -410,26 +1295,15 @@ def view_wishlist():
     conn = get_db_connection()
     c = conn.cursor()
     
-    c.execute('''
-        SELECT products.*, ratings.avg_rating FROM products
-        JOIN wishlist ON products.id = wishlist.product_id
-        LEFT JOIN (
-            SELECT product_id, AVG(rating) as avg_rating FROM ratings GROUP BY product_id
-        ) as ratings ON products.id = ratings.product_id
-        WHERE wishlist.user_username = ?
-    ''', (username,))
-    
-    wishlist_items = c.fetchall()
-    conn.close()
-    
-    rates = {
-        "USD": 1.0,
-        "EUR": 0.85,
-        "GBP": 0.75,
-        "JPY": 110.0
-    }
-    
-    return render_template('wishlist.html', wishlist_items=wishlist_items, rates=rates)
+    currency = request.args.get('currency', 'USD')
+    generation = wishlist_cache.get(username)[1]
+    # Ratings come from each product's stored aggregates, not from scanning the ratings table
+    c.execute(WISHLIST_PRODUCTS_QUERY, (username,))
+    products = c.fetchall()
+    wishlist_cache.put(username, frozenset(p['id'] for p in products), generation)
+
+    return render_template('wishlist.html', wishlist_items=build_product_list(products, currency),
+                           currency=currency)
 
 @app.route('/remove_from_wishlist/<int:product_id>', methods=['POST'])
 def remove_from_wishlist(product_id):
@@ -443,7 +1317,7 @@ def remove_from_wishlist(product_id):
     
     c.execute('DELETE FROM wishlist WHERE user_username = ? AND product_id = ?', (username, product_id))
     conn.commit()
-    conn.close()
+    wishlist_cache.invalidate([username])
     
     flash("Product removed from your wishlist.", "info")
     return redirect(url_for('view_wishlist'))
@@ -456,15 +1330,7 @@ def users():
         return redirect(url_for('login'))
     
     current_user = session['username']
-    threshold = datetime.utcnow() - timedelta(minutes=5)  # Users active in last 5 minutes
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('''
-        SELECT username, name FROM users 
-        WHERE username != ? AND last_active >= ?
-    ''', (current_user, threshold.strftime('%Y-%m-%d %H:%M:%S')))
-    online_users = c.fetchall()
-    conn.close()
+    online_users = [user for user in get_online_users() if user['username'] != current_user]
     return render_template('users.html', users=online_users)
 
 @app.route('/active_chats')
@@ -475,12 +1341,9 @@ def active_chats():
     current_user = session['username']
     conn = get_db_connection()
     c = conn.cursor()
-    c.execute('''
-        SELECT * FROM chats
-        WHERE (user1 = ? OR user2 = ?) AND status = "active"
-    ''', (current_user, current_user))
+    # The user's own rows in user_chats, with each chat's latest message looked up by id
+    c.execute(ACTIVE_CHATS_QUERY, (current_user,))
     chats = c.fetchall()
-    conn.close()
     return render_template('active_chats.html', chats=chats)
 
 @app.route('/start_chat/<to_username>', methods=['POST'])
@@ -497,35 +1360,32 @@ def start_chat(to_username):
     c = conn.cursor()
 
     # Check if a chat already exists and is active
-    c.execute('''SELECT chats.id FROM chats
-                 WHERE ((user1 = ? AND user2 = ?) OR (user1 = ? AND user2 = ?))
-                 AND status = "active"''',
+    c.execute(ACTIVE_CHAT_BETWEEN_QUERY,
               (from_username, to_username, to_username, from_username))
     chat = c.fetchone()
 
     if chat:
         chat_id = chat['id']
         flash("Active chat already exists.", "info")
-        conn.close()
         return redirect(url_for('chat_room', chat_id=chat_id))
 
     # Check if a pending chat request exists
-    c.execute('''SELECT * FROM chat_requests
-                 WHERE from_user = ? AND to_user = ? AND status = "pending"''',
-              (from_username, to_username))
+    c.execute(PENDING_REQUEST_QUERY, (from_username, to_username))
     existing_request = c.fetchone()
 
     if existing_request:
         flash("Chat request already sent.", "info")
-        conn.close()
         return redirect(url_for('users'))
 
     # Create a new chat request
-    c.execute('''INSERT INTO chat_requests (from_user, to_user)
-                 VALUES (?, ?)''',
-              (from_username, to_username))
-    conn.commit()
-    conn.close()
+    try:
+        c.execute('''INSERT INTO chat_requests (from_user, to_user)
+                     VALUES (?, ?)''',
+                  (from_username, to_username))
+        conn.commit()
+    except sqlite3.IntegrityError:
+        flash("User not found.", "danger")
+        return redirect(url_for('users'))
 
     flash("Chat request sent.", "success")
     return redirect(url_for('users'))
@@ -545,13 +1405,15 @@ def end_chat(chat_id):
 
     if not chat or chat['status'] != 'active':
         flash("Chat not found or already ended.", "danger")
-        conn.close()
         return redirect(url_for('active_chats'))
 
     # End the chat by updating its status
-    c.execute('UPDATE chats SET status = "ended" WHERE id = ?', (chat_id,))
+    c.execute(END_CHATS_QUERY.format(placeholders='?'), (chat_id,))
+    c.execute(DELETE_USER_CHATS_QUERY.format(placeholders='?'), (chat_id,))
     conn.commit()
-    conn.close()
+    chat_access_cache.invalidate([chat_id])
+    chat_broker.close(chat_id)
+    message_archiver.schedule([chat_id])
 
     flash("Chat ended successfully.", "info")
     return redirect(url_for('active_chats'))
@@ -564,9 +1426,8 @@ def chat_requests():
     username = session['username']
     conn = get_db_connection()
     c = conn.cursor()
-    c.execute('SELECT * FROM chat_requests WHERE to_user = ? AND status = "pending"', (username,))
+    c.execute(INCOMING_REQUESTS_QUERY, (username,))
     requests = c.fetchall()
-    conn.close()
     return render_template('chat_requests.html', requests=requests)
 
 @app.route('/accept_chat/<int:request_id>', methods=['POST'])
@@ -584,7 +1445,6 @@ def accept_chat(request_id):
 
     if not chat_request:
         flash("Chat request not found.", "danger")
-        conn.close()
         return redirect(url_for('chat_requests'))
 
     # Update the chat request status to 'accepted'
@@ -595,9 +1455,11 @@ def accept_chat(request_id):
     to_user = chat_request['to_user']
     c.execute('INSERT INTO chats (user1, user2) VALUES (?, ?)', (from_user, to_user))
     chat_id = c.lastrowid
+    c.executemany('INSERT INTO user_chats (username, chat_id, other_user) VALUES (?, ?, ?)',
+                  [(from_user, chat_id, to_user), (to_user, chat_id, from_user)])
 
     conn.commit()
-    conn.close()
+    chat_access_cache.invalidate([chat_id])
 
     flash("Chat request accepted.", "success")
     return redirect(url_for('chat_room', chat_id=chat_id))
@@ -617,14 +1479,12 @@ def decline_chat(request_id):
 
     if not chat_request:
         flash("Chat request not found.", "danger")
-        conn.close()
         return redirect(url_for('chat_requests'))
 
     # Update the chat request status to 'declined'
     c.execute('UPDATE chat_requests SET status = "declined" WHERE id = ?', (request_id,))
 
     conn.commit()
-    conn.close()
 
     flash("Chat request declined.", "info")
     return redirect(url_for('chat_requests'))
@@ -635,36 +1495,61 @@ def chat_room(chat_id):
         return redirect(url_for('login'))
 
     username = session['username']
-    conn = get_db_connection()
-    c = conn.cursor()
 
     # Retrieve the chat
-    c.execute('SELECT * FROM chats WHERE id = ?', (chat_id,))
-    chat = c.fetchone()
+    chat = get_chat(chat_id)
 
     if not chat:
         flash("Chat not found.", "danger")
-        conn.close()
         return redirect(url_for('marketplace'))
 
     if username not in [chat['user1'], chat['user2']]:
         flash("You are not a participant of this chat.", "danger")
-        conn.close()
         return redirect(url_for('marketplace'))
 
     if chat['status'] != 'active':
         flash("This chat has been ended.", "info")
-        conn.close()
         return redirect(url_for('active_chats'))
 
-    # Retrieve messages
-    c.execute('SELECT * FROM messages WHERE chat_id = ? ORDER BY timestamp ASC', (chat_id,))
-    messages = c.fetchall()
-    conn.close()
+    # Only the most recent messages; older ones are fetched on demand
+    conn = get_db_connection()
+    messages, has_older = fetch_message_page(conn.cursor(), chat_id, None, CHAT_HISTORY_PAGE_SIZE)
+    mark_chat_read(conn, username, chat_id, messages)
 
     other_user = chat['user2'] if chat['user1'] == username else chat['user1']
 
-    return render_template('chat_room.html', chat_id=chat_id, messages=messages, other_user=other_user)
+    return render_template('chat_room.html', chat_id=chat_id, messages=messages, other_user=other_user,
+                           has_older=has_older)
+
+@app.route('/older_messages/<int:chat_id>')
+def older_messages(chat_id):
+    if 'username' not in session:
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+
+    username = session['username']
+    conn = get_db_connection()
+    c = conn.cursor()
+
+    # Verify chat exists, is active, and user is a participant
+    if not get_active_chat(chat_id, username):
+        return jsonify({"status": "error", "message": "Chat not found or unauthorized"}), 404
+
+    before_id = request.args.get('before_id', type=int)
+    limit = max(1, min(request.args.get('limit', CHAT_HISTORY_PAGE_SIZE, type=int), CHAT_HISTORY_PAGE_SIZE))
+    messages, has_older = fetch_message_page(c, chat_id, before_id, limit)
+
+    return jsonify({"status": "success", "messages": messages, "has_older": has_older}), 200
+
+def fetch_message_page(c, chat_id, before_id, limit):
+    # Walk the (chat_id, id) index backwards from before_id, then return the page oldest first
+    if before_id is None:
+        c.execute(LATEST_MESSAGES_QUERY, (chat_id, limit + 1))
+    else:
+        c.execute(MESSAGES_BEFORE_QUERY, (chat_id, before_id, limit + 1))
+    rows = c.fetchall()
+    has_older = len(rows) > limit
+    messages = [dict(row) for row in reversed(rows[:limit])]
+    return messages, has_older
 
 @app.route('/send_message/<int:chat_id>', methods=['POST'])
 def send_message(chat_id):
@@ -677,25 +1562,64 @@ def send_message(chat_id):
     if not content:
         return jsonify({"status": "error", "message": "Empty message"}), 400
 
-    conn = get_db_connection()
-    c = conn.cursor()
-
     # Verify chat exists, is active, and user is a participant
-    c.execute('SELECT * FROM chats WHERE id = ? AND status = "active"', (chat_id,))
-    chat = c.fetchone()
-
-    if not chat or username not in [chat['user1'], chat['user2']]:
-        conn.close()
+    if not get_active_chat(chat_id, username):
         return jsonify({"status": "error", "message": "Chat not found or unauthorized"}), 404
 
-    # Insert the message
-    c.execute('''INSERT INTO messages (chat_id, sender, content)
-                 VALUES (?, ?, ?)''',
-              (chat_id, username, content))
+    timestamp = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    if MESSAGE_WRITE_MODE in ('group', 'queued'):
+        message = message_writer.submit(chat_id, username, content, timestamp)
+        if MESSAGE_WRITE_MODE == 'queued':
+            # The writer thread publishes to open streams once the message is committed
+            return jsonify({"status": "success", "message": "Message queued"}), 202
+        if not message.committed.wait(MESSAGE_COMMIT_TIMEOUT_SECONDS) or message.error:
+            return jsonify({"status": "error", "message": "Message could not be saved"}), 503
+        return jsonify({"status": "success", "message": "Message sent", "id": message.id}), 200
+
+    message_id = store_message(get_db_connection(), chat_id, username, content, timestamp)
+    return jsonify({"status": "success", "message": "Message sent", "id": message_id}), 200
+
+_chat_send_locks = [threading.Lock() for _ in range(CHAT_SEND_LOCK_STRIPES)]
+
+def store_message(conn, chat_id, sender, content, timestamp):
+    # Streams skip ids at or below the last one they sent, so messages to a chat must be
+    # published in id order: insert, commit and publish under the chat's lock
+    with _chat_send_locks[chat_id % CHAT_SEND_LOCK_STRIPES]:
+        c = conn.cursor()
+        c.execute('''INSERT INTO messages (chat_id, sender, content, timestamp)
+                     VALUES (?, ?, ?, ?)''',
+                  (chat_id, sender, content, timestamp))
+        message_id = c.lastrowid
+        record_chat_message(c, chat_id, sender, message_id)
+        conn.commit()
+
+        # Push to participants with an open stream; no database read needed on their side
+        chat_broker.publish(chat_id, {
+            "id": message_id,
+            "sender": sender,
+            "content": content,
+            "timestamp": timestamp
+        })
+    return message_id
+
+def record_chat_message(c, chat_id, sender, message_id):
+    # Both participants' user_chats rows in one statement: the sender has read up to their own
+    # message, and the other participant has one more unread
+    c.execute(RECORD_MESSAGE_QUERY, (message_id, sender, sender, message_id, chat_id))
+
+def mark_chat_read(conn, username, chat_id, messages):
+    # messages have been shown to username; nothing is written unless one came from the other user
+    if not any(message['sender'] != username for message in messages):
+        return
+    last_id = max(message['id'] for message in messages)
+    conn.execute(MARK_READ_QUERY,
+                 (last_id, chat_id, last_id, username, username, chat_id, last_id))
     conn.commit()
-    conn.close()
 
-    return jsonify({"status": "success", "message": "Message sent"}), 200
+def fetch_unread_counts(conn, username):
+    # Badge numbers for the navigation bar, from two index lookups
+    row = conn.execute(UNREAD_COUNTS_QUERY, (username, username)).fetchone()
+    return dict(row)
 
 @app.route('/get_messages/<int:chat_id>')
 def get_messages(chat_id):
@@ -707,52 +1631,162 @@ def get_messages(chat_id):
     c = conn.cursor()
 
     # Verify chat exists, is active, and user is a participant
-    c.execute('SELECT * FROM chats WHERE id = ? AND status = "active"', (chat_id,))
-    chat = c.fetchone()
-
-    if not chat or username not in [chat['user1'], chat['user2']]:
-        conn.close()
+    if not get_active_chat(chat_id, username):
         return jsonify({"status": "error", "message": "Chat not found or unauthorized"}), 404
 
-    # Retrieve messages
-    c.execute('SELECT * FROM messages WHERE chat_id = ? ORDER BY timestamp ASC', (chat_id,))
-    messages = c.fetchall()
-    conn.close()
-
-    messages_list = []
-    for msg in messages:
-        messages_list.append({
-            "sender": msg['sender'],
-            "content": msg['content'],
-            "timestamp": msg['timestamp']
-        })
+    # Only return messages newer than the last one the client has seen
+    after_id = request.args.get('after_id', 0, type=int)
+    messages_list = fetch_messages_after(c, chat_id, after_id)
+    mark_chat_read(conn, username, chat_id, messages_list)
+
+    last_id = messages_list[-1]['id'] if messages_list else after_id
 
-    return jsonify({"status": "success", "messages": messages_list}), 200
+    # Let clients revalidate with If-None-Match; an unchanged chat answers 304 with no body
+    response = jsonify({"status": "success", "messages": messages_list, "last_id": last_id})
+    response.set_etag(f"chat-{chat_id}-{last_id}")
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+def fetch_messages_after(c, chat_id, after_id):
+    c.execute(MESSAGES_AFTER_QUERY, (chat_id, after_id))
+    return [dict(msg) for msg in c.fetchall()]
+
+@app.route('/stream_messages/<int:chat_id>')
+def stream_messages(chat_id):
+    if 'username' not in session:
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+
+    username = session['username']
+    conn = get_db_connection()
+    c = conn.cursor()
+
+    # Verify chat exists, is active, and user is a participant
+    if not get_active_chat(chat_id, username):
+        return jsonify({"status": "error", "message": "Chat not found or unauthorized"}), 404
+
+    # Subscribe before reading the backlog so nothing sent in between is missed
+    listener = chat_broker.subscribe(chat_id)
+
+    # Catch up on anything newer than what the client already has (EventSource
+    # sends Last-Event-ID on reconnect)
+    after_id = request.headers.get('Last-Event-ID', type=int)
+    if after_id is None:
+        after_id = request.args.get('after_id', 0, type=int)
+    backlog = fetch_messages_after(c, chat_id, after_id)
+    mark_chat_read(conn, username, chat_id, backlog)
+
+    def format_event(msg):
+        return f"id: {msg['id']}\ndata: {json.dumps(msg)}\n\n"
+
+    def generate():
+        last_id = after_id
+        for msg in backlog:
+            last_id = msg['id']
+            yield format_event(msg)
+        while True:
+            try:
+                msg = listener.get(timeout=STREAM_KEEPALIVE_SECONDS)
+            except queue.Empty:
+                yield ": keepalive\n\n"
+                continue
+            if msg is None:
+                yield "event: ended\ndata: {}\n\n"
+                return
+            if msg['id'] <= last_id:
+                continue
+            last_id = msg['id']
+            yield format_event(msg)
+            if msg['sender'] != username:
+                # The request's connection has gone back to the pool by now
+                stream_conn = db_pool.acquire()
+                try:
+                    mark_chat_read(stream_conn, username, chat_id, [msg])
+                finally:
+                    db_pool.release(stream_conn)
+
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.call_on_close(lambda: chat_broker.unsubscribe(chat_id, listener))
+    return response
+
+@app.route('/metrics')
+def metrics():
+    # Prometheus text format; under serve.py each worker reports its own numbers
+    return Response(request_metrics.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/ping', methods=['POST'])
 def ping():
-    if 'username' in session:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute('UPDATE users SET last_active = CURRENT_TIMESTAMP WHERE username = ?', (session['username'],))
-        conn.commit()
-        conn.close()
-    return jsonify({"status": "success"}), 200
+    # update_last_active has already recorded the user as seen
+    if 'username' not in session:
+        return jsonify({"status": "success"}), 200
+    counts = fetch_unread_counts(get_db_connection(), session['username'])
+    return jsonify({"status": "success", **counts}), 200
+
+def build_fts_query(search_query):
+    # Quote each word so user input can't inject FTS5 syntax, and match it as a prefix
+    terms = re.findall(r'\w+', search_query)
+    return ' '.join(f'"{term}"*' for term in terms)
 
 def convert_currency(amount, from_currency, to_currency):
-    rates = {
-        "USD": 1.0,
-        "EUR": 0.85,
-        "GBP": 0.75,
-        "JPY": 110.0
-    }
-    try:
-        usd_amount = amount / rates[from_currency]
-        converted_amount = usd_amount * rates[to_currency]
-        return converted_amount
-    except KeyError:
-        return amount
+    return rate_provider.convert(amount, from_currency, to_currency)
+
+def checked_queries():
+    # Hot queries with representative parameters for `migrations.py --check`, built by the same
+    # constants and builders the routes use
+    no_filters = {"category": None, "min_price": None, "max_price": None, "min_rating": None}
+    listings = [
+        ('', 'id', no_filters, None),
+        ('', 'newest', no_filters, None),
+        ('', 'price_asc', no_filters, encode_cursor('price_asc', 1.0, 1)),
+        ('', 'rating', no_filters, None),
+        ('', 'rating', dict(no_filters, min_rating=4.0), None),
+        ('', 'id', dict(no_filters, category='home'), None),
+        ('', 'price_asc', dict(no_filters, min_price=1.0, max_price=100.0), None),
+        ('lamp', 'relevance', no_filters, None),
+        ('%', 'id', no_filters, None),  # No word characters, so the LIKE fallback
+    ]
+    queries = []
+    for search_query, sort, filters, cursor in listings:
+        query, params, _ = build_marketplace_page_query(search_query, sort, filters, cursor, MARKETPLACE_PAGE_SIZE)
+        queries.append((query, params))
+    for search_query in ('', 'lamp', '%'):
+        queries.append(build_category_counts_query(search_query, no_filters))
+
+    two = ', '.join('?' * 2)
+    queries += [
+        (USER_BY_NAME_QUERY, ('u',)),
+        (ONLINE_USERS_QUERY, ('2000-01-01 00:00:00',)),
+        (ONLINE_OR_PENDING_USERS_QUERY.format(placeholders=two), ('2000-01-01 00:00:00', 'u', 'v')),
+        (PRESENCE_FLUSH_QUERY, ('2000-01-01 00:00:00', 'u', '2000-01-01 00:00:00')),
+        (LOGOUT_QUERY, (OFFLINE_LAST_ACTIVE, '2000-01-01 00:00:00', 'u')),
+        (LOGIN_QUERY, ('2000-01-01 00:00:00', None, 'u')),
+        (PURCHASE_QUERY, ('u', 1, 'u')),
+        (PURCHASE_FAILURE_QUERY, (1,)),
+        (RATING_AGGREGATE_QUERY, (5, 1)),
+        (WISHLIST_IDS_QUERY, ('u',)),
+        (WISHLIST_PRODUCTS_QUERY, ('u',)),
+        (CHAT_BY_ID_QUERY, (1,)),
+        (ACTIVE_CHAT_BETWEEN_QUERY, ('u', 'v', 'v', 'u')),
+        (PENDING_REQUEST_QUERY, ('u', 'v')),
+        (INCOMING_REQUESTS_QUERY, ('u',)),
+        (USER_CHAT_IDS_QUERY, ('u',)),
+        (ACTIVE_CHATS_QUERY, ('u',)),
+        (END_CHATS_QUERY.format(placeholders=two), (1, 2)),
+        (DELETE_USER_CHATS_QUERY.format(placeholders=two), (1, 2)),
+        (RECORD_MESSAGE_QUERY, (1, 'u', 'u', 1, 1)),
+        (MARK_READ_QUERY, (1, 1, 1, 'u', 'u', 1, 1)),
+        (UNREAD_COUNTS_QUERY, ('u', 'u')),
+        (MESSAGES_AFTER_QUERY, (1, 0)),
+        (LATEST_MESSAGES_QUERY, (1, CHAT_HISTORY_PAGE_SIZE + 1)),
+        (MESSAGES_BEFORE_QUERY, (1, 100, CHAT_HISTORY_PAGE_SIZE + 1)),
+        (RELAY_MESSAGES_QUERY, (0,)),
+        (RELAY_ENDED_CHATS_QUERY.format(placeholders=two), (1, 2)),
+        (ENDED_CHATS_WITH_MESSAGES_QUERY, ()),
+    ]
+    return queries
 
 if __name__ == '__main__':
     init_database()
+    share_listing_version()
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,292 @@
+# asgi.py
+#
+# ASGI entry point: uvicorn asgi:application --host 0.0.0.0 --port 5000
+#
+# The chat and presence endpoints are served here as async handlers, so an idle
+# chat stream or a waiting poll costs a coroutine instead of a thread. Database
+# work runs on a small thread pool with pooled connections. Every other route is
+# passed through to the Flask app unchanged.
+
+import asyncio
+import contextvars
+import json
+import time
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qs
+
+from a2wsgi import WSGIMiddleware
+from itsdangerous import BadSignature
+
+import app as auboutique
+from metrics import start_query_stats, stop_query_stats
+
+DB_THREADS = auboutique.DB_POOL_MAX_IDLE  # One pooled connection per database thread
+MAX_FORM_BYTES = 64 * 1024  # Largest /send_message body accepted
+FLASK_THREADS = 32  # Threads serving the page routes passed through to Flask
+
+db_executor = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix='asgi-db')
+flask_application = WSGIMiddleware(auboutique.app, workers=FLASK_THREADS)
+
+def run_db_call(fn, args):
+    conn = auboutique.db_pool.acquire()
+    try:
+        return fn(conn, *args)
+    finally:
+        auboutique.db_pool.release(conn)
+
+async def run_db(fn, *args):
+    # fn(conn, *args) on a database thread; the copied context carries the request's query stats
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(db_executor, context.run, run_db_call, fn, args)
+
+class StreamListener:
+    """Chat broker listener that hands messages to an asyncio queue from any thread."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.queue = asyncio.Queue()
+
+    def put(self, message):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, message)
+
+def session_username(scope):
+    # Reads the same signed cookie Flask's session uses
+    flask_app = auboutique.app
+    cookie = SimpleCookie()
+    for name, value in scope['headers']:
+        if name == b'cookie':
+            cookie.load(value.decode('latin-1'))
+    morsel = cookie.get(flask_app.config['SESSION_COOKIE_NAME'])
+    if morsel is None:
+        return None
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    try:
+        data = serializer.loads(morsel.value,
+                                max_age=int(flask_app.permanent_session_lifetime.total_seconds()))
+    except BadSignature:
+        return None
+    return data.get('username')
+
+def header(scope, name):
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+def query_int(scope, name, default=None):
+    values = parse_qs(scope['query_string'].decode('latin-1')).get(name)
+    try:
+        return int(values[0]) if values else default
+    except ValueError:
+        return default
+
+async def read_body(receive, limit):
+    body = b''
+    while True:
+        event = await receive()
+        body += event.get('body', b'')
+        if len(body) > limit:
+            return None
+        if not event.get('more_body'):
+            return body
+
+async def send_response(send, status, body, content_type='application/json', headers=()):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type.encode()),
+                    (b'content-length', str(len(body)).encode())] + list(headers),
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+async def send_json(send, status, data, headers=()):
+    await send_response(send, status, json.dumps(data).encode(), headers=headers)
+
+async def active_chat(chat_id, username):
+    # Cache hits never leave the event loop
+    chat, generation = auboutique.chat_access_cache.get(chat_id)
+    if chat is None:
+        chat = await run_db(auboutique.load_chat, chat_id, generation)
+    return chat if auboutique.can_use_chat(chat, username) else None
+
+def fetch_messages_after(conn, username, chat_id, after_id):
+    # Messages the user is about to be shown also count as read
+    messages = auboutique.fetch_messages_after(conn.cursor(), chat_id, after_id)
+    auboutique.mark_chat_read(conn, username, chat_id, messages)
+    return messages
+
+async def get_messages(scope, receive, send, username, chat_id):
+    if not await active_chat(chat_id, username):
+        return await send_json(send, 404, {"status": "error", "message": "Chat not found or unauthorized"})
+
+    after_id = query_int(scope, 'after_id', 0)
+    messages_list = await run_db(fetch_messages_after, username, chat_id, after_id)
+    last_id = messages_list[-1]['id'] if messages_list else after_id
+
+    # Same validators as the Flask view, so polling clients can mix both
+    etag = f'"chat-{chat_id}-{last_id}"'
+    headers = [(b'etag', etag.encode()), (b'cache-control', b'no-cache')]
+    if_none_match = header(scope, b'if-none-match')
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(',')]:
+        await send({'type': 'http.response.start', 'status': 304, 'headers': headers})
+        return await send({'type': 'http.response.body', 'body': b''})
+    await send_json(send, 200, {"status": "success", "messages": messages_list, "last_id": last_id},
+                    headers=headers)
+
+async def send_message(scope, receive, send, username, chat_id):
+    body = await read_body(receive, MAX_FORM_BYTES)
+    if body is None:
+        return await send_json(send, 413, {"status": "error", "message": "Message too large"})
+    content = parse_qs(body.decode('utf-8', 'replace')).get('message', [''])[0].strip()
+    if not content:
+        return await send_json(send, 400, {"status": "error", "message": "Empty message"})
+
+    if not await active_chat(chat_id, username):
+        return await send_json(send, 404, {"status": "error", "message": "Chat not found or unauthorized"})
+
+    timestamp = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    if auboutique.MESSAGE_WRITE_MODE in ('group', 'queued'):
+        message = auboutique.message_writer.submit(chat_id, username, content, timestamp)
+        if auboutique.MESSAGE_WRITE_MODE == 'queued':
+            return await send_json(send, 202, {"status": "success", "message": "Message queued"})
+        committed = await asyncio.get_running_loop().run_in_executor(
+            None, message.committed.wait, auboutique.MESSAGE_COMMIT_TIMEOUT_SECONDS)
+        if not committed or message.error:
+            return await send_json(send, 503, {"status": "error", "message": "Message could not be saved"})
+        return await send_json(send, 200, {"status": "success", "message": "Message sent", "id": message.id})
+
+    message_id = await run_db(auboutique.store_message, chat_id, username, content, timestamp)
+    await send_json(send, 200, {"status": "success", "message": "Message sent", "id": message_id})
+
+async def stream_messages(scope, receive, send, username, chat_id):
+    if not await active_chat(chat_id, username):
+        return await send_json(send, 404, {"status": "error", "message": "Chat not found or unauthorized"})
+
+    # Subscribe before reading the backlog so nothing sent in between is missed
+    listener = StreamListener(asyncio.get_running_loop())
+    auboutique.chat_broker.subscribe(chat_id, listener)
+    try:
+        after_id = header(scope, b'last-event-id')
+        after_id = int(after_id) if after_id and after_id.isdigit() else query_int(scope, 'after_id', 0)
+        backlog = await run_db(fetch_messages_after, username, chat_id, after_id)
+
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(b'content-type', b'text/event-stream; charset=utf-8'),
+                        (b'cache-control', b'no-cache'),
+                        (b'x-accel-buffering', b'no')],
+        })
+
+        async def send_event(text):
+            await send({'type': 'http.response.body', 'body': text.encode(), 'more_body': True})
+
+        last_id = after_id
+        for msg in backlog:
+            last_id = msg['id']
+            await send_event(f"id: {msg['id']}\ndata: {json.dumps(msg)}\n\n")
+
+        # With the (empty) request body read, the next receive() only returns on disconnect
+        await read_body(receive, MAX_FORM_BYTES)
+        disconnected = asyncio.ensure_future(receive())
+        try:
+            while True:
+                next_message = asyncio.ensure_future(listener.queue.get())
+                done, _ = await asyncio.wait({next_message, disconnected},
+                                             timeout=auboutique.STREAM_KEEPALIVE_SECONDS,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if disconnected in done:
+                    next_message.cancel()
+                    return
+                if not done:
+                    next_message.cancel()
+                    await send_event(": keepalive\n\n")
+                    continue
+                msg = next_message.result()
+                if msg is None:
+                    await send_event("event: ended\ndata: {}\n\n")
+                    break
+                if msg['id'] <= last_id:
+                    continue
+                last_id = msg['id']
+                await send_event(f"id: {msg['id']}\ndata: {json.dumps(msg)}\n\n")
+                if msg['sender'] != username:
+                    await run_db(auboutique.mark_chat_read, username, chat_id, [msg])
+        finally:
+            disconnected.cancel()
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        auboutique.chat_broker.unsubscribe(chat_id, listener)
+
+async def ping(scope, receive, send, username):
+    await read_body(receive, MAX_FORM_BYTES)
+    counts = await run_db(auboutique.fetch_unread_counts, username)
+    await send_json(send, 200, {"status": "success", **counts})
+
+# (method, path pattern, handler); captured groups are passed on as ints
+ASYNC_ROUTES = [
+    ('GET', re.compile(r'/get_messages/(\d+)'), get_messages),
+    ('POST', re.compile(r'/send_message/(\d+)'), send_message),
+    ('GET', re.compile(r'/stream_messages/(\d+)'), stream_messages),
+    ('POST', re.compile(r'/ping'), ping),
+]
+
+def match_async_route(scope):
+    for method, pattern, handler in ASYNC_ROUTES:
+        match = pattern.fullmatch(scope['path'])
+        if match and scope['method'] == method:
+            return handler, [int(group) for group in match.groups()]
+    return None, None
+
+async def lifespan(receive, send):
+    while True:
+        event = await receive()
+        if event['type'] == 'lifespan.startup':
+            await asyncio.get_running_loop().run_in_executor(None, auboutique.init_database)
+            if auboutique.listing_cache.counters is None:
+                # Not already shared by serve.py
+                auboutique.share_listing_version()
+            await send({'type': 'lifespan.startup.complete'})
+        elif event['type'] == 'lifespan.shutdown':
+            db_executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+
+    handler, args = (None, None)
+    if scope['type'] == 'http':
+        handler, args = match_async_route(scope)
+        # Multipart posts and the like are left to Flask's form parser
+        content_type = (header(scope, b'content-type') or '').split(';')[0].strip().lower()
+        if handler is send_message and content_type not in ('', 'application/x-www-form-urlencoded'):
+            handler = None
+    if handler is None:
+        return await flask_application(scope, receive, send)
+
+    # Recorded under the same endpoint names as the Flask views
+    started = time.perf_counter()
+    stats, token = start_query_stats()
+    status = 500
+
+    async def send_and_record_status(event):
+        nonlocal status
+        if event['type'] == 'http.response.start':
+            status = event['status']
+        await send(event)
+
+    try:
+        username = session_username(scope)
+        if username is None:
+            return await send_json(send_and_record_status, 401, {"status": "error", "message": "Unauthorized"})
+        # Same bookkeeping as Flask's before_request hook
+        auboutique.presence.touch(username)
+        await handler(scope, receive, send_and_record_status, username, *args)
+    finally:
+        stop_query_stats(token)
+        auboutique.request_metrics.observe(handler.__name__, status, time.perf_counter() - started, stats)
@@ -0,0 +1,406 @@
+# benchmark.py
+
+import argparse
+import http.client
+import json
+import os
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode, urlsplit
+
+import app as auboutique
+import seed_data
+from migrations import migrate
+
+BASELINE_FILE = 'benchmark_baseline.json'
+# Relative weight of each scripted user action
+DEFAULT_MIX = 'browse=45,search=20,chat=25,buy=5,login=5'
+# Database built for --target test
+DEFAULT_DATA = {'users': 200, 'products': 5000, 'ratings': 20000, 'chats': 400, 'messages': 10000}
+SORTS = ['', 'newest', 'price_asc', 'price_desc', 'rating']
+CURRENCIES = ['USD', 'USD', 'USD', 'EUR', 'GBP', 'JPY']
+SEND_SHARE = 0.3  # Share of chat actions that also send a message
+NEXT_PAGE_SHARE = 0.3  # Share of browse actions that scroll to a second page
+LOGIN_ATTEMPTS = 10  # Tries at each virtual user's first login while the server is busy
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+# Failure thresholds when comparing against a baseline
+MAX_LATENCY_REGRESSION = 0.25  # p95 may grow by this fraction
+MAX_THROUGHPUT_DROP = 0.25  # Requests per second may shrink by this fraction
+MAX_QUERY_INCREASE = 0.2  # SQL statements per request may grow by this fraction
+MAX_ERROR_RATE = 0.01  # Share of failed requests: see request_failed
+
+class TestClientSession:
+    """Sends requests through Flask's test client, in this process."""
+
+    def __init__(self):
+        self.client = auboutique.app.test_client()
+
+    def request(self, method, path, data=None):
+        response = self.client.open(path, method=method, data=data)
+        return response.status_code, response.headers, response.get_data()
+
+class HttpSession:
+    """Sends requests to a running server over one keep-alive connection, keeping its cookies."""
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.cookies = SimpleCookie()
+        self.conn = None
+
+    def request(self, method, path, data=None):
+        headers = {}
+        body = None
+        if data is not None:
+            body = urlencode(data)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        if self.cookies:
+            headers['Cookie'] = '; '.join(f'{name}={morsel.value}' for name, morsel in self.cookies.items())
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+            try:
+                self.conn.request(method, path, body=body, headers=headers)
+                response = self.conn.getresponse()
+                content = response.read()
+                break
+            except (http.client.HTTPException, OSError):
+                # The server may close idle keep-alive connections; retry once on a new one
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    raise
+        for cookie in response.headers.get_all('Set-Cookie') or []:
+            self.cookies.load(cookie)
+        return response.status, response.headers, content
+
+def redirects_to_login(status, headers):
+    return status in REDIRECT_STATUSES and urlsplit(headers.get('Location', '')).path == '/login'
+
+def request_failed(status, headers):
+    # Server errors, and requests turned away because the session isn't logged in
+    return status >= 500 or status == 401 or redirects_to_login(status, headers)
+
+def login_succeeded(status, headers):
+    # A successful login redirects to the marketplace; a rejected one renders the form again
+    return status in REDIRECT_STATUSES and not redirects_to_login(status, headers)
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.aborted = []
+        self.recording = False
+
+    def abort(self, username):
+        with self._lock:
+            self.aborted.append(username)
+
+    def record(self, operation, seconds, failed):
+        if not self.recording:
+            return
+        with self._lock:
+            self.latencies.setdefault(operation, []).append(seconds)
+            if failed:
+                self.errors[operation] = self.errors.get(operation, 0) + 1
+
+class VirtualUser:
+    """One logged-in user running the scripted mix of actions."""
+
+    def __init__(self, session, username, chat_ids, product_ids, recorder, mix, seed):
+        self.session = session
+        self.username = username
+        self.chat_ids = chat_ids
+        self.product_ids = product_ids
+        self.recorder = recorder
+        self.actions = list(mix)
+        self.weights = list(mix.values())
+        self.rng = random.Random(seed)
+        self.last_message_ids = {}
+
+    def call(self, operation, method, path, data=None, succeeded=None):
+        started = time.perf_counter()
+        try:
+            status, headers, body = self.session.request(method, path, data)
+        except (http.client.HTTPException, OSError):
+            self.recorder.record(operation, time.perf_counter() - started, True)
+            return None, b''
+        if succeeded is None:
+            failed = request_failed(status, headers)
+        else:
+            failed = not succeeded(status, headers)
+        self.recorder.record(operation, time.perf_counter() - started, failed)
+        return status, body
+
+    def login(self):
+        self.call('login', 'POST', '/login', {'username': self.username, 'password': seed_data.SEED_PASSWORD},
+                  login_succeeded)
+
+    def sign_in(self, stop_at):
+        # The first login is setup, not measured. It is retried while the hashing pool answers
+        # 503, as a browser following Retry-After would.
+        for _ in range(LOGIN_ATTEMPTS):
+            try:
+                status, headers, _ = self.session.request(
+                    'POST', '/login', {'username': self.username, 'password': seed_data.SEED_PASSWORD})
+            except (http.client.HTTPException, OSError):
+                status, headers = None, {}
+            if status is not None and login_succeeded(status, headers):
+                return True
+            if status not in (None, 503) or time.monotonic() >= stop_at:
+                return False
+            retry_after = headers.get('Retry-After', '1')
+            time.sleep(float(retry_after) if retry_after.isdigit() else 1)
+        return False
+
+    def run(self, stop_at):
+        # A user that can't log in would only time redirects to /login, so it sits the run out
+        if not self.sign_in(stop_at):
+            self.recorder.abort(self.username)
+            return
+        while time.monotonic() < stop_at:
+            action = self.rng.choices(self.actions, self.weights)[0]
+            getattr(self, action)()
+
+    def browse(self):
+        params = {'sort': self.rng.choice(SORTS), 'currency': self.rng.choice(CURRENCIES)}
+        if self.rng.random() < 0.3:
+            params['category'] = self.rng.choice(list(seed_data.CATALOG))
+        self.call('marketplace', 'GET', '/marketplace?' + urlencode(params))
+        if self.rng.random() < NEXT_PAGE_SHARE:
+            status, body = self.call('marketplace_page', 'GET', '/marketplace/page?' + urlencode(params))
+            cursor = json.loads(body).get('next_cursor') if status == 200 else None
+            if cursor:
+                self.call('marketplace_page', 'GET', '/marketplace/page?' + urlencode(dict(params, cursor=cursor)))
+
+    def search(self):
+        _, _, nouns = seed_data.CATALOG[self.rng.choice(list(seed_data.CATALOG))]
+        term = self.rng.choice(nouns + seed_data.ADJECTIVES)
+        self.call('search', 'GET', '/marketplace?' + urlencode({'search': term, 'sort': 'relevance'}))
+
+    def chat(self):
+        if not self.chat_ids:
+            return self.browse()
+        chat_id = self.rng.choice(self.chat_ids)
+        after_id = self.last_message_ids.get(chat_id, 0)
+        status, body = self.call('get_messages', 'GET', f'/get_messages/{chat_id}?after_id={after_id}')
+        if status == 200:
+            self.last_message_ids[chat_id] = json.loads(body).get('last_id', after_id)
+        if self.rng.random() < SEND_SHARE:
+            self.call('send_message', 'POST', f'/send_message/{chat_id}', {'message': 'Is this still available?'})
+
+    def buy(self):
+        self.call('buy_product', 'POST', f'/buy_product/{self.rng.choice(self.product_ids)}')
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(','):
+        action, _, weight = item.partition('=')
+        if action.strip() not in ('browse', 'search', 'chat', 'buy', 'login'):
+            raise ValueError(f"Unknown action '{action}'")
+        mix[action.strip()] = float(weight)
+    return mix
+
+def pick_users(database, count):
+    # Seeded users with active chats first, so the chat action has something to poll
+    conn = sqlite3.connect(f'file:{database}?mode=ro', uri=True)
+    try:
+        chats = {}
+        for chat_id, user1, user2 in conn.execute("SELECT id, user1, user2 FROM chats WHERE status = 'active'"):
+            chats.setdefault(user1, []).append(chat_id)
+            chats.setdefault(user2, []).append(chat_id)
+        seeded = [row[0] for row in conn.execute('SELECT username FROM users WHERE username LIKE ? ORDER BY rowid',
+                                                 (seed_data.USERNAME_PREFIX + '%',))]
+        product_ids = [row[0] for row in conn.execute('SELECT id FROM products WHERE sold = 0')]
+    finally:
+        conn.close()
+    if not seeded:
+        raise SystemExit(f"No seeded users in '{database}'; run seed_data.py first.")
+    ordered = sorted(seeded, key=lambda username: username not in chats)
+    usernames = [ordered[i % len(ordered)] for i in range(count)]
+    return [(username, chats.get(username, [])) for username in usernames], product_ids or [1]
+
+def read_query_counts(session):
+    # {endpoint: (requests, statements)} from /metrics
+    status, _, body = session.request('GET', '/metrics')
+    counts = {}
+    if status != 200:
+        return counts
+    for line in body.decode().splitlines():
+        match = re.match(r'auboutique_request_queries_(sum|count)\{endpoint="([^"]+)"\} (\S+)', line)
+        if match:
+            kind, endpoint, value = match.groups()
+            requests, statements = counts.get(endpoint, (0, 0))
+            if kind == 'count':
+                requests = float(value)
+            else:
+                statements = float(value)
+            counts[endpoint] = (requests, statements)
+    return counts
+
+# Recorded operation name -> Flask endpoint its queries are reported under
+OPERATION_ENDPOINTS = {'search': 'marketplace_search'}
+
+def percentile(sorted_values, fraction):
+    # Nearest-rank percentile
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+def summarize(recorder, elapsed, before, after):
+    operations = {}
+    total = 0
+    errors = 0
+    for operation, latencies in sorted(recorder.latencies.items()):
+        latencies.sort()
+        endpoint = OPERATION_ENDPOINTS.get(operation, operation)
+        requests = after.get(endpoint, (0, 0))[0] - before.get(endpoint, (0, 0))[0]
+        statements = after.get(endpoint, (0, 0))[1] - before.get(endpoint, (0, 0))[1]
+        operations[operation] = {
+            "count": len(latencies),
+            "errors": recorder.errors.get(operation, 0),
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+            "queries_per_request": round(statements / requests, 2) if requests else None,
+        }
+        total += len(latencies)
+        errors += recorder.errors.get(operation, 0)
+    return {
+        "requests": total,
+        "errors": errors,
+        "aborted_users": len(recorder.aborted),
+        "duration_s": round(elapsed, 2),
+        "rps": round(total / elapsed, 1) if elapsed else 0,
+        "operations": operations,
+    }
+
+def print_results(results):
+    print(f"{'operation':<18}{'count':>8}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'queries':>9}")
+    for operation, stats in results['operations'].items():
+        queries = '-' if stats['queries_per_request'] is None else f"{stats['queries_per_request']:.2f}"
+        print(f"{operation:<18}{stats['count']:>8}{stats['errors']:>8}{stats['p50_ms']:>10.2f}"
+              f"{stats['p95_ms']:>10.2f}{stats['p99_ms']:>10.2f}{queries:>9}")
+    print(f"{results['requests']} requests in {results['duration_s']}s: {results['rps']} requests/s, "
+          f"{results['errors']} errors")
+    if results['aborted_users']:
+        print(f"{results['aborted_users']} virtual users could not log in and did not run")
+
+def compare(results, baseline, args):
+    # Returns the list of regressions past the thresholds
+    failures = []
+    if results['rps'] < baseline['rps'] * (1 - args.max_throughput_drop):
+        failures.append(f"throughput {results['rps']} requests/s vs baseline {baseline['rps']}")
+    for operation, base in baseline['operations'].items():
+        current = results['operations'].get(operation)
+        if current is None:
+            continue
+        if current['p95_ms'] > base['p95_ms'] * (1 + args.max_latency_regression):
+            failures.append(f"{operation} p95 {current['p95_ms']} ms vs baseline {base['p95_ms']} ms")
+        if (current['queries_per_request'] is not None and base['queries_per_request'] is not None
+                and current['queries_per_request'] > base['queries_per_request'] * (1 + args.max_query_increase)):
+            failures.append(f"{operation} runs {current['queries_per_request']} queries per request "
+                            f"vs baseline {base['queries_per_request']}")
+    return failures
+
+def prepare_test_target(args):
+    # A throwaway seeded database so the real one is never touched
+    workdir = tempfile.mkdtemp()
+    # Under load many statements cross the slow-query threshold; the report covers latency instead
+    auboutique.SLOW_QUERY_MS = 0
+    auboutique.DATABASE = os.path.join(workdir, 'benchmark.db')
+    migrate(auboutique.DATABASE)
+    conn = auboutique.connect_database()
+    try:
+        seed_data.seed_database(conn, args.users, args.products, args.ratings, args.chats, args.messages, args.seed)
+    finally:
+        conn.close()
+    return auboutique.DATABASE, TestClientSession
+
+def run_benchmark(args):
+    mix = parse_mix(args.mix)
+    if args.target == 'test':
+        database, make_session = prepare_test_target(args)
+    else:
+        database, make_session = args.database, lambda: HttpSession(args.url)
+
+    users, product_ids = pick_users(database, args.concurrency)
+    recorder = Recorder()
+    stop_at = time.monotonic() + args.warmup + args.duration
+    virtual_users = [VirtualUser(make_session(), username, chat_ids, product_ids, recorder, mix, args.seed + i)
+                     for i, (username, chat_ids) in enumerate(users)]
+    threads = [threading.Thread(target=user.run, args=(stop_at,), daemon=True) for user in virtual_users]
+    for thread in threads:
+        thread.start()
+
+    # Only the time after the warmup counts
+    time.sleep(args.warmup)
+    metrics_session = make_session()
+    before = read_query_counts(metrics_session)
+    recorder.recording = True
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    recorder.recording = False
+    after = read_query_counts(metrics_session)
+    return summarize(recorder, elapsed, before, after)
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a scripted user mix against the app and report latency.")
+    parser.add_argument('--target', choices=['test', 'http'], default='test',
+                        help="test: Flask test client on a fresh seeded database; http: a running server")
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help="Server for --target http")
+    parser.add_argument('--database', default=seed_data.DATABASE,
+                        help="Seeded database the --target http server uses; read to pick users and chats")
+    parser.add_argument('--concurrency', type=int, default=8, help="Virtual users running at once")
+    parser.add_argument('--duration', type=float, default=20, help="Seconds measured")
+    parser.add_argument('--warmup', type=float, default=3, help="Seconds run before measuring")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="Relative weights of browse, search, chat, buy, login")
+    parser.add_argument('--seed', type=int, default=1)
+    for table, count in DEFAULT_DATA.items():
+        parser.add_argument(f'--{table}', type=int, default=count, help=f"Seeded {table} for --target test")
+    parser.add_argument('--baseline', default=BASELINE_FILE, help="Results to compare against, if the file exists")
+    parser.add_argument('--save-baseline', action='store_true', help="Store these results as the new baseline")
+    parser.add_argument('--max-latency-regression', type=float, default=MAX_LATENCY_REGRESSION)
+    parser.add_argument('--max-throughput-drop', type=float, default=MAX_THROUGHPUT_DROP)
+    parser.add_argument('--max-query-increase', type=float, default=MAX_QUERY_INCREASE)
+    parser.add_argument('--max-error-rate', type=float, default=MAX_ERROR_RATE)
+    args = parser.parse_args()
+
+    results = run_benchmark(args)
+    results['config'] = {"target": args.target, "concurrency": args.concurrency, "mix": args.mix,
+                         "seed": args.seed}
+    print_results(results)
+
+    failures = []
+    if results['requests'] and results['errors'] / results['requests'] > args.max_error_rate:
+        failures.append(f"{results['errors']} of {results['requests']} requests failed")
+    if results['aborted_users']:
+        failures.append(f"{results['aborted_users']} virtual users could not log in")
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved baseline to {args.baseline}.")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('config') != results['config']:
+            print(f"Warning: {args.baseline} was recorded with {baseline.get('config')}.")
+        failures += compare(results, baseline, args)
+        if not failures:
+            print(f"Within thresholds of {args.baseline}.")
+
+    for failure in failures:
+        print(f"Regression: {failure}")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,184 @@
+# bulk_products.py
+
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+
+import app as auboutique
+from migrations import migrate
+from product_images import MAX_IMAGE_BYTES, decode_inline_image, store_image
+
+DATABASE = 'auboutique.db'  # Ensure this path matches your project's database path
+BATCH_SIZE = 10000  # Rows inserted per transaction
+MAX_REPORTED_ERRORS = 20
+
+PRODUCT_FIELDS = ['name', 'description', 'price', 'currency', 'image', 'seller', 'quantity', 'category']
+EXPORT_PRODUCT_FIELDS = ['id'] + PRODUCT_FIELDS + ['buyer', 'sold', 'rating_count', 'rating_sum']
+EXPORT_RATING_FIELDS = ['product_id', 'rating']
+
+def file_format(path, requested):
+    if requested:
+        return requested
+    return 'jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv'
+
+def read_rows(path, fmt):
+    # Yields (line number, row dict) without loading the whole file
+    with open(path, newline='', encoding='utf-8') as f:
+        if fmt == 'csv':
+            for line_number, row in enumerate(csv.DictReader(f), start=2):
+                yield line_number, row
+        else:
+            for line_number, line in enumerate(f, start=1):
+                if line.strip():
+                    try:
+                        yield line_number, json.loads(line)
+                    except ValueError:
+                        yield line_number, None
+
+def import_products(conn, path, fmt, default_seller, batch_size):
+    known_sellers = {}
+    currencies = auboutique.rate_provider.rates()
+    imported = 0
+    rejected = 0
+    batch = []
+
+    def seller_exists(seller):
+        if seller not in known_sellers:
+            row = conn.execute('SELECT 1 FROM users WHERE username = ?', (seller,)).fetchone()
+            known_sellers[seller] = row is not None
+        return known_sellers[seller]
+
+    def reject(line_number, reason):
+        nonlocal rejected
+        rejected += 1
+        if rejected <= MAX_REPORTED_ERRORS:
+            print(f"Line {line_number}: {reason}")
+
+    def flush():
+        nonlocal imported
+        if not batch:
+            return
+        conn.executemany('''INSERT INTO products
+                            (name, description, price, currency, image, image_hash, seller, quantity, category,
+                             sold, price_usd)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 0, ?)''', batch)
+        conn.commit()
+        imported += len(batch)
+        batch.clear()
+
+    started = time.perf_counter()
+    for line_number, row in read_rows(path, fmt):
+        if not isinstance(row, dict):
+            reject(line_number, "Not a valid JSON object.")
+            continue
+        fields = {key: '' if row.get(key) is None else str(row.get(key)).strip() for key in PRODUCT_FIELDS}
+
+        # Same checks as the add_product form
+        price, quantity, error = auboutique.validate_product(fields['name'], fields['price'], fields['quantity'],
+                                                             fields['category'], fields['description'])
+        if error:
+            reject(line_number, error)
+            continue
+        currency = fields['currency'] or 'USD'
+        if currency not in currencies:
+            reject(line_number, f"Unknown currency '{currency}'.")
+            continue
+        seller = fields['seller'] or default_seller
+        if not seller or not seller_exists(seller):
+            reject(line_number, f"Seller '{seller}' is not a registered user.")
+            continue
+
+        # Inline base64 images are stored as files like uploads; URLs are kept as they are.
+        # Thumbnails are made the first time a page asks for one.
+        image, image_hash = fields['image'] or None, None
+        data = decode_inline_image(image) if image else None
+        if data is not None:
+            if len(data) > MAX_IMAGE_BYTES:
+                reject(line_number, f"Image is larger than {MAX_IMAGE_BYTES // (1024 * 1024)} MB.")
+                continue
+            image, image_hash = None, store_image(data)
+
+        batch.append((fields['name'], fields['description'], price, currency, image, image_hash, seller,
+                      quantity, fields['category'], auboutique.convert_currency(price, currency, 'USD')))
+        if len(batch) >= batch_size:
+            flush()
+    flush()
+    elapsed = time.perf_counter() - started
+
+    if rejected > MAX_REPORTED_ERRORS:
+        print(f"... and {rejected - MAX_REPORTED_ERRORS} more rejected rows.")
+    print(f"Imported {imported} products in {elapsed:.1f}s ({imported / max(elapsed, 1e-9):.0f} rows/s), "
+          f"rejected {rejected}.")
+    return rejected == 0
+
+def write_rows(path, fmt, fields, rows):
+    count = 0
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        if fmt == 'csv':
+            writer = csv.writer(f)
+            writer.writerow(fields)
+            for row in rows:
+                writer.writerow(row)
+                count += 1
+        else:
+            for row in rows:
+                f.write(json.dumps(dict(zip(fields, row))) + '\n')
+                count += 1
+    return count
+
+def export_catalog(conn, path, fmt, ratings_path):
+    # Cursors are iterated directly so rows stream from SQLite to the file
+    started = time.perf_counter()
+    products = conn.execute(f"SELECT {', '.join(EXPORT_PRODUCT_FIELDS)} FROM products ORDER BY id")
+    count = write_rows(path, fmt, EXPORT_PRODUCT_FIELDS, products)
+    print(f"Exported {count} products to {path} in {time.perf_counter() - started:.1f}s.")
+
+    if ratings_path:
+        started = time.perf_counter()
+        ratings = conn.execute(f"SELECT {', '.join(EXPORT_RATING_FIELDS)} FROM ratings ORDER BY product_id")
+        count = write_rows(ratings_path, file_format(ratings_path, None), EXPORT_RATING_FIELDS, ratings)
+        print(f"Exported {count} ratings to {ratings_path} in {time.perf_counter() - started:.1f}s.")
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk import or export marketplace products.")
+    parser.add_argument('--database', default=DATABASE)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    import_parser = subparsers.add_parser('import', help="Load products from a CSV or JSON Lines file")
+    import_parser.add_argument('path')
+    import_parser.add_argument('--format', choices=['csv', 'jsonl'])
+    import_parser.add_argument('--seller', help="Seller for rows that don't name one")
+    import_parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+
+    export_parser = subparsers.add_parser('export', help="Write the catalog to a CSV or JSON Lines file")
+    export_parser.add_argument('path')
+    export_parser.add_argument('--format', choices=['csv', 'jsonl'])
+    export_parser.add_argument('--ratings', help="Also write all ratings to this file")
+
+    args = parser.parse_args()
+    if not os.path.exists(args.database):
+        print(f"Database '{args.database}' does not exist. Please run the main application to create the database first.")
+        return 1
+
+    migrate(args.database)
+    auboutique.DATABASE = args.database
+    conn = auboutique.connect_database()
+    try:
+        if args.command == 'import':
+            ok = import_products(conn, args.path, file_format(args.path, args.format), args.seller,
+                                 max(1, args.batch_size))
+            # Running servers follow the catalog version in the state file; bump it so they
+            # drop listing pages cached before the import
+            auboutique.share_listing_version()
+            auboutique.listing_cache.invalidate()
+            return 0 if ok else 1
+        export_catalog(conn, args.path, file_format(args.path, args.format), args.ratings)
+        return 0
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    sys.exit(main())
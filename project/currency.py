@@ -0,0 +1,121 @@
+# currency.py
+
+import json
+import math
+import os
+import threading
+import time
+
+RATES_FILE = 'currency_rates.json'  # Units of each currency per 1 USD
+RELOAD_CHECK_SECONDS = 5  # How often the rates file is checked for changes
+
+# Used when the rates file is missing or unreadable
+DEFAULT_RATES = {
+    "USD": 1.0,
+    "EUR": 0.85,
+    "GBP": 0.75,
+    "JPY": 110.0
+}
+
+def usd_price_update(rates):
+    # SQL and parameters that recompute products.price_usd at these rates; unchanged rows aren't written
+    cases = ' '.join('WHEN ? THEN ?' for _ in rates)
+    params = [value for item in rates.items() for value in item]
+    usd_price = f'price / CASE currency {cases} ELSE 1.0 END'
+    return f'UPDATE products SET price_usd = {usd_price} WHERE price_usd IS NOT {usd_price}', params * 2
+
+def parse_rates(data):
+    # Raises ValueError unless every rate is a positive number and USD is among them
+    try:
+        rates = {code: float(rate) for code, rate in data.items()}
+    except (AttributeError, TypeError) as e:
+        raise ValueError(e)
+    if 'USD' not in rates:
+        raise ValueError("no USD rate")
+    invalid = sorted(code for code, rate in rates.items() if not 0 < rate < math.inf)
+    if invalid:
+        raise ValueError(f"rates must be positive numbers: {', '.join(invalid)}")
+    return rates
+
+class RateProvider:
+    """Exchange rates loaded from a JSON file, reloaded when the file changes."""
+
+    def __init__(self, path=RATES_FILE, check_interval=RELOAD_CHECK_SECONDS):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._listeners = []
+        self._mtime = None
+        self._rates = None
+        self._matrix = None
+        self._next_check = 0
+        if not self._load():
+            self._set_rates(dict(DEFAULT_RATES))
+
+    def _load(self):
+        # Returns whether the file was loaded. Otherwise the last good rates stay in use, and
+        # the bad file's mtime is kept so it isn't loaded again until it changes.
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            mtime = None
+        try:
+            with open(self.path) as f:
+                rates = parse_rates(json.load(f))
+        except (OSError, ValueError) as e:
+            if self._rates is not None or os.path.exists(self.path):
+                print(f"[Currency] Could not load '{self.path}': {e}")
+            self._mtime = mtime
+            return False
+        self._set_rates(rates)
+        self._mtime = mtime
+        return True
+
+    def _set_rates(self, rates):
+        # Precompute every pairwise conversion factor once per load
+        matrix = {source: {target: rates[target] / rates[source] for target in rates} for source in rates}
+        self._rates, self._matrix = rates, matrix
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        with self._lock:
+            if now < self._next_check:
+                return
+            self._next_check = now + self.check_interval
+            try:
+                mtime = os.path.getmtime(self.path)
+            except OSError:
+                mtime = None
+            if mtime == self._mtime or not self._load():
+                return
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener(self._rates)
+
+    def on_reload(self, listener):
+        # listener(rates) is called after the rates file changes; usable as a decorator
+        self._listeners.append(listener)
+        return listener
+
+    def rates(self):
+        self._maybe_reload()
+        return self._rates
+
+    def currencies(self):
+        return sorted(self.rates())
+
+    def convert(self, amount, from_currency, to_currency):
+        self._maybe_reload()
+        try:
+            return amount * self._matrix[from_currency][to_currency]
+        except KeyError:
+            return amount
+
+    def convert_many(self, prices, to_currency):
+        # prices is an iterable of (amount, currency); converted in one pass
+        # against a single snapshot of the matrix
+        self._maybe_reload()
+        factors = {source: row[to_currency] for source, row in self._matrix.items() if to_currency in row}
+        return [amount * factors.get(currency, 1.0) for amount, currency in prices]
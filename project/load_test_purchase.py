@@ -0,0 +1,100 @@
+# load_test_purchase.py
+
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+import app as auboutique
+from migrations import migrate
+
+def run_load_test(buyers, quantity):
+    # Work on a throwaway database so the real one is never touched
+    workdir = tempfile.mkdtemp()
+    auboutique.DATABASE = os.path.join(workdir, 'load_test.db')
+    migrate(auboutique.DATABASE)
+
+    conn = sqlite3.connect(auboutique.DATABASE)
+    usernames = [f'buyer{i}' for i in range(buyers)]
+    conn.executemany('INSERT INTO users (username, password, name, email) VALUES (?, ?, ?, ?)',
+                     [(u, '-', u, f'{u}@example.com') for u in ['seller'] + usernames])
+    c = conn.execute('''INSERT INTO products (name, description, price, currency, seller, quantity, category, sold)
+                        VALUES ('Flash sale item', 'Limited stock', 10, 'USD', 'seller', ?, 'sale', 0)''',
+                     (quantity,))
+    product_id = c.lastrowid
+    conn.commit()
+    conn.close()
+
+    # Log every buyer in up front so the timed section is only purchases
+    clients = []
+    for username in usernames:
+        client = auboutique.app.test_client()
+        with client.session_transaction() as sess:
+            sess['username'] = username
+        clients.append(client)
+
+    start_barrier = threading.Barrier(buyers + 1)
+    errors = []
+    outcomes = {'purchased': 0, 'unavailable': 0}
+    database_errors = []
+    lock = threading.Lock()
+
+    def buy(client):
+        start_barrier.wait()
+        response = client.post(f'/buy_product/{product_id}')
+        if response.status_code != 302:
+            with lock:
+                errors.append(response.status_code)
+            return
+        # buy_product redirects whatever happened; the flashed message says what did
+        with client.session_transaction() as sess:
+            flashes = sess.get('_flashes', [])
+        category, message = flashes[-1] if flashes else ('danger', 'No message flashed')
+        with lock:
+            if category == 'success':
+                outcomes['purchased'] += 1
+            elif message.startswith('Database error'):
+                database_errors.append(message)
+            else:
+                outcomes['unavailable'] += 1
+
+    threads = [threading.Thread(target=buy, args=(client,)) for client in clients]
+    for thread in threads:
+        thread.start()
+    start_barrier.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    conn = sqlite3.connect(auboutique.DATABASE)
+    final_quantity, sold = conn.execute('SELECT quantity, sold FROM products WHERE id = ?', (product_id,)).fetchone()
+    conn.close()
+
+    expected_quantity = max(quantity - buyers, 0)
+    expected_purchases = min(buyers, quantity)
+    print(f"{buyers} concurrent buys of a product with quantity {quantity} in {elapsed:.2f}s "
+          f"({buyers / elapsed:.0f} purchases/s)")
+    print(f"Successful purchases: {outcomes['purchased']} (expected {expected_purchases}), "
+          f"turned away as unavailable: {outcomes['unavailable']}")
+    print(f"Final quantity: {final_quantity} (expected {expected_quantity}), sold: {bool(sold)}")
+    if database_errors:
+        # Includes buys that gave up after PURCHASE_MAX_ATTEMPTS tries at a busy write lock
+        busy = sum('locked' in message or 'busy' in message for message in database_errors)
+        print(f"{len(database_errors)} purchases failed with a database error ({busy} on a busy database): "
+              f"{sorted(set(database_errors))}")
+    if errors:
+        print(f"{len(errors)} requests failed with status codes {sorted(set(errors))}")
+
+    return (outcomes['purchased'] == expected_purchases and final_quantity == expected_quantity
+            and bool(sold) == (expected_quantity == 0) and not database_errors and not errors)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fire concurrent purchases at one product and check for overselling.")
+    parser.add_argument('--buyers', type=int, default=300, help="Number of concurrent buyers")
+    parser.add_argument('--quantity', type=int, default=100, help="Starting stock of the product")
+    args = parser.parse_args()
+    sys.exit(0 if run_load_test(args.buyers, args.quantity) else 1)
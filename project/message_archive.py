@@ -0,0 +1,68 @@
+# message_archive.py
+
+import json
+import os
+import sqlite3
+import zlib
+
+DATABASE = 'auboutique.db'  # Ensure this path matches your project's database path
+ENDED_CHATS_WITH_MESSAGES_QUERY = '''SELECT id FROM chats
+                                     WHERE status = 'ended'
+                                     AND EXISTS (SELECT 1 FROM messages WHERE messages.chat_id = chats.id)'''
+
+def archive_chat(conn, chat_id):
+    # Move an ended chat's messages into one compressed row so the hot messages table stays small.
+    # Returns the number of messages archived.
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        c = conn.cursor()
+        c.execute('SELECT status FROM chats WHERE id = ?', (chat_id,))
+        chat = c.fetchone()
+        if not chat or chat[0] != 'ended':
+            conn.rollback()
+            return 0
+
+        c.execute('SELECT id, sender, content, timestamp FROM messages WHERE chat_id = ? ORDER BY id ASC',
+                  (chat_id,))
+        messages = [{"id": row[0], "sender": row[1], "content": row[2], "timestamp": row[3]}
+                    for row in c.fetchall()]
+        if not messages:
+            conn.rollback()
+            return 0
+
+        # A chat is only archived once, but merge just in case messages were left behind
+        messages = load_archived_messages(conn, chat_id) + messages
+        payload = zlib.compress(json.dumps(messages).encode())
+        c.execute('''INSERT OR REPLACE INTO message_archive (chat_id, message_count, payload)
+                     VALUES (?, ?, ?)''', (chat_id, len(messages), payload))
+        c.execute('DELETE FROM messages WHERE chat_id = ?', (chat_id,))
+        conn.commit()
+        return len(messages)
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+
+def load_archived_messages(conn, chat_id):
+    row = conn.execute('SELECT payload FROM message_archive WHERE chat_id = ?', (chat_id,)).fetchone()
+    if not row:
+        return []
+    return json.loads(zlib.decompress(row[0]))
+
+def archive_ended_chats(conn):
+    # Sweep every ended chat that still has messages in the hot table
+    chat_ids = [row[0] for row in conn.execute(ENDED_CHATS_WITH_MESSAGES_QUERY)]
+    archived = 0
+    for chat_id in chat_ids:
+        archived += archive_chat(conn, chat_id)
+    return len(chat_ids), archived
+
+if __name__ == "__main__":
+    if os.path.exists(DATABASE):
+        from migrations import migrate
+        migrate(DATABASE)
+        conn = sqlite3.connect(DATABASE, isolation_level=None)
+        chats, archived = archive_ended_chats(conn)
+        conn.close()
+        print(f"Archived {archived} messages from {chats} ended chats.")
+    else:
+        print(f"Database '{DATABASE}' does not exist. Please run the main application to create the database first.")
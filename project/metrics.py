@@ -0,0 +1,188 @@
+# metrics.py
+
+import bisect
+import contextvars
+import sqlite3
+import threading
+import time
+
+# Upper bounds of the histogram buckets; Prometheus adds +Inf
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+class QueryStats:
+    """SQL statements run for one request and the time spent in them."""
+
+    __slots__ = ('count', 'seconds')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+_request_queries = contextvars.ContextVar('request_queries', default=None)
+
+def start_query_stats():
+    # Returns (stats, token); pass the token to stop_query_stats
+    stats = QueryStats()
+    return stats, _request_queries.set(stats)
+
+def stop_query_stats(token):
+    _request_queries.reset(token)
+
+def count_statement(statement):
+    # sqlite3 trace callback: called for every statement, including BEGIN/COMMIT and trigger bodies
+    stats = _request_queries.get()
+    if stats is not None:
+        stats.count += 1
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that times execute and fetch calls and reports slow statements.
+
+    The trace callback only says that a statement ran, not how long it took, so timing
+    happens here. Rows read by iterating the cursor are not timed.
+    """
+
+    def execute(self, sql, parameters=()):
+        self._statement = sql
+        self._elapsed = 0.0
+        self._reported = False
+        return self._timed(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        self._statement = sql
+        self._elapsed = 0.0
+        self._reported = False
+        return self._timed(super().executemany, sql, seq_of_parameters)
+
+    def fetchone(self):
+        return self._timed(super().fetchone)
+
+    def fetchmany(self, *args):
+        return self._timed(super().fetchmany, *args)
+
+    def fetchall(self):
+        return self._timed(super().fetchall)
+
+    def _timed(self, call, *args):
+        started = time.perf_counter()
+        try:
+            return call(*args)
+        finally:
+            elapsed = time.perf_counter() - started
+            stats = _request_queries.get()
+            if stats is not None:
+                stats.seconds += elapsed
+            if hasattr(self, '_statement'):
+                self._elapsed += elapsed
+                threshold = self.connection.slow_query_seconds
+                if threshold is not None and self._elapsed >= threshold and not self._reported:
+                    self._reported = True
+                    statement = ' '.join(self._statement.split())
+                    print(f"[SQL] Slow query ({self._elapsed * 1000:.1f} ms): {statement}")
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection whose cursors are InstrumentedCursors; pass as sqlite3.connect(factory=...)."""
+
+    slow_query_seconds = None  # Statements at least this slow are logged; None disables the log
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+class Histogram:
+    """Bucketed counts of observed values, rendered as a Prometheus histogram."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{format_labels(labels, le=bound)} {cumulative}')
+        lines.append(f'{name}_sum{format_labels(labels)} {self.sum}')
+        lines.append(f'{name}_count{format_labels(labels)} {self.count}')
+        return lines
+
+def format_labels(labels, **extra):
+    items = list(labels.items()) + list(extra.items())
+    if not items:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in items)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(items, escaped)) + '}'
+
+class EndpointMetrics:
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.queries = Histogram(QUERY_COUNT_BUCKETS)
+        self.query_seconds = 0.0
+        self.responses = {}
+
+class RequestMetrics:
+    """Per-endpoint request latency and SQL use, exposed in the Prometheus text format."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+        self._values = []
+
+    def observe(self, endpoint, status, seconds, stats):
+        with self._lock:
+            metrics = self._endpoints.get(endpoint)
+            if metrics is None:
+                metrics = self._endpoints[endpoint] = EndpointMetrics()
+            metrics.latency.observe(seconds)
+            metrics.queries.observe(stats.count)
+            metrics.query_seconds += stats.seconds
+            metrics.responses[status] = metrics.responses.get(status, 0) + 1
+
+    def expose(self, name, help_text, read, kind='gauge'):
+        # read() is called at scrape time
+        self._values.append((name, help_text, read, kind))
+
+    def render(self):
+        with self._lock:
+            endpoints = sorted(self._endpoints.items())
+            lines = [
+                '# HELP auboutique_request_duration_seconds Time to produce a response, by endpoint.',
+                '# TYPE auboutique_request_duration_seconds histogram',
+            ]
+            for endpoint, metrics in endpoints:
+                lines += metrics.latency.render('auboutique_request_duration_seconds', {"endpoint": endpoint})
+            lines += [
+                '# HELP auboutique_requests_total Responses sent, by endpoint and status code.',
+                '# TYPE auboutique_requests_total counter',
+            ]
+            for endpoint, metrics in endpoints:
+                for status, count in sorted(metrics.responses.items()):
+                    lines.append(f'auboutique_requests_total{format_labels({"endpoint": endpoint, "status": status})} {count}')
+            lines += [
+                '# HELP auboutique_request_queries SQL statements run per request, by endpoint.',
+                '# TYPE auboutique_request_queries histogram',
+            ]
+            for endpoint, metrics in endpoints:
+                lines += metrics.queries.render('auboutique_request_queries', {"endpoint": endpoint})
+            lines += [
+                '# HELP auboutique_request_query_seconds_total Time spent in SQL, by endpoint.',
+                '# TYPE auboutique_request_query_seconds_total counter',
+            ]
+            for endpoint, metrics in endpoints:
+                lines.append(f'auboutique_request_query_seconds_total{format_labels({"endpoint": endpoint})} '
+                             f'{metrics.query_seconds}')
+        for name, help_text, read, kind in self._values:
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}', f'{name} {read()}']
+        return '\n'.join(lines) + '\n'
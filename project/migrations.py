@@ -0,0 +1,265 @@
+# migrations.py
+
+import sqlite3
+import os
+import sys
+
+from currency import RateProvider, usd_price_update
+from product_images import MAX_IMAGE_BYTES, decode_inline_image, store_image
+
+DATABASE = 'auboutique.db'  # Ensure this path matches your project's database path
+
+# Expression the marketplace sorts by for "Top rated"; the index below must use the exact same text
+RATING_SORT_KEY = 'COALESCE(CAST(rating_sum AS REAL) / NULLIF(rating_count, 0), 0)'
+
+def column_names(c, table):
+    c.execute(f"PRAGMA table_info({table})")
+    return [info[1] for info in c.fetchall()]
+
+def create_base_tables(c):
+    """Create the core tables"""
+    c.execute('''CREATE TABLE IF NOT EXISTS users
+                (username TEXT PRIMARY KEY,
+                 password TEXT NOT NULL,
+                 name TEXT NOT NULL,
+                 email TEXT NOT NULL,
+                 last_active DATETIME DEFAULT CURRENT_TIMESTAMP)''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS products
+                (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 name TEXT NOT NULL,
+                 description TEXT NOT NULL,
+                 price REAL NOT NULL,
+                 currency TEXT NOT NULL,
+                 image TEXT,
+                 seller TEXT NOT NULL,
+                 buyer TEXT,
+                 sold BOOLEAN DEFAULT 0,
+                 quantity INTEGER DEFAULT 1,
+                 category TEXT,
+                 FOREIGN KEY (seller) REFERENCES users(username))''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS ratings
+                (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 product_id INTEGER,
+                 rating INTEGER,
+                 FOREIGN KEY (product_id) REFERENCES products(id))''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS chat_requests
+                (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 from_user TEXT NOT NULL,
+                 to_user TEXT NOT NULL,
+                 status TEXT DEFAULT 'pending',
+                 timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                 FOREIGN KEY (from_user) REFERENCES users(username),
+                 FOREIGN KEY (to_user) REFERENCES users(username))''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS chats
+                (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 user1 TEXT NOT NULL,
+                 user2 TEXT NOT NULL,
+                 status TEXT DEFAULT 'active',
+                 FOREIGN KEY (user1) REFERENCES users(username),
+                 FOREIGN KEY (user2) REFERENCES users(username))''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS messages
+                (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 chat_id INTEGER NOT NULL,
+                 sender TEXT NOT NULL,
+                 content TEXT NOT NULL,
+                 timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                 FOREIGN KEY (chat_id) REFERENCES chats(id),
+                 FOREIGN KEY (sender) REFERENCES users(username))''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS wishlist
+                (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 user_username TEXT NOT NULL,
+                 product_id INTEGER NOT NULL,
+                 added_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                 FOREIGN KEY (user_username) REFERENCES users(username),
+                 FOREIGN KEY (product_id) REFERENCES products(id),
+                 UNIQUE(user_username, product_id))''')
+
+    # Databases created by early versions of the app lack these columns
+    if 'last_active' not in column_names(c, 'users'):
+        c.execute('ALTER TABLE users ADD COLUMN last_active DATETIME')
+        c.execute('UPDATE users SET last_active = CURRENT_TIMESTAMP')
+    if 'status' not in column_names(c, 'chats'):
+        c.execute("ALTER TABLE chats ADD COLUMN status TEXT DEFAULT 'active'")
+
+def add_rating_aggregates(c):
+    """Add per-product rating count and sum maintained by rate_product"""
+    if 'rating_count' not in column_names(c, 'products'):
+        c.execute('ALTER TABLE products ADD COLUMN rating_count INTEGER NOT NULL DEFAULT 0')
+        c.execute('ALTER TABLE products ADD COLUMN rating_sum INTEGER NOT NULL DEFAULT 0')
+    c.execute('''UPDATE products SET
+                 rating_count = (SELECT COUNT(*) FROM ratings WHERE ratings.product_id = products.id),
+                 rating_sum = (SELECT COALESCE(SUM(rating), 0) FROM ratings WHERE ratings.product_id = products.id)''')
+
+def add_price_usd(c):
+    """Add USD-normalized price so listings in different currencies sort together"""
+    if 'price_usd' not in column_names(c, 'products'):
+        c.execute('ALTER TABLE products ADD COLUMN price_usd REAL')
+    # At the rates in the current rates file, as the app uses
+    c.execute(*usd_price_update(RateProvider().rates()))
+
+def create_products_fts(c):
+    """Create the full-text search index over products, kept in sync by triggers"""
+    c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5
+                 (name, description, category, content='products', content_rowid='id')''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products BEGIN
+                     INSERT INTO products_fts (rowid, name, description, category)
+                     VALUES (new.id, new.name, new.description, new.category);
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products BEGIN
+                     INSERT INTO products_fts (products_fts, rowid, name, description, category)
+                     VALUES ('delete', old.id, old.name, old.description, old.category);
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS products_fts_update AFTER UPDATE OF name, description, category ON products BEGIN
+                     INSERT INTO products_fts (products_fts, rowid, name, description, category)
+                     VALUES ('delete', old.id, old.name, old.description, old.category);
+                     INSERT INTO products_fts (rowid, name, description, category)
+                     VALUES (new.id, new.name, new.description, new.category);
+                 END''')
+    c.execute("INSERT INTO products_fts (products_fts) VALUES ('rebuild')")
+
+def create_lookup_indexes(c):
+    """Index every column the app filters or sorts on"""
+    # Chat messages are read by (chat_id, id > last seen id)
+    c.execute('CREATE INDEX IF NOT EXISTS idx_messages_chat_id ON messages (chat_id, id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_ratings_product_id ON ratings (product_id, rating)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_users_last_active ON users (last_active)')
+
+    # Marketplace keyset pagination, one index per sort order
+    c.execute('CREATE INDEX IF NOT EXISTS idx_products_sold_id ON products (sold, id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_products_sold_price ON products (sold, price_usd, id)')
+    c.execute(f'CREATE INDEX IF NOT EXISTS idx_products_sold_rating ON products (sold, {RATING_SORT_KEY}, id)')
+
+    # Either side of a chat can look it up; OR queries use both indexes
+    c.execute('CREATE INDEX IF NOT EXISTS idx_chats_user1 ON chats (user1, status)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_chats_user2 ON chats (user2, status)')
+
+    c.execute('CREATE INDEX IF NOT EXISTS idx_chat_requests_to_user ON chat_requests (to_user, status)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_chat_requests_from_user ON chat_requests (from_user, to_user, status)')
+
+def create_facet_indexes(c):
+    """Index the marketplace category filter and facet counts"""
+    c.execute('CREATE INDEX IF NOT EXISTS idx_products_sold_category ON products (sold, category, price_usd)')
+
+def create_message_archive(c):
+    """Create the compressed per-chat archive for messages of ended chats"""
+    c.execute('''CREATE TABLE IF NOT EXISTS message_archive
+                (chat_id INTEGER PRIMARY KEY,
+                 message_count INTEGER NOT NULL,
+                 archived_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                 payload BLOB NOT NULL,
+                 FOREIGN KEY (chat_id) REFERENCES chats(id))''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_chats_status ON chats (status)')
+
+def move_inline_images(c):
+    """Move base64 product images out of the products table into content-addressed files"""
+    if 'image_hash' not in column_names(c, 'products'):
+        c.execute('ALTER TABLE products ADD COLUMN image_hash TEXT')
+    # Image URLs are short and stay in products.image
+    c.execute("SELECT id FROM products WHERE image IS NOT NULL AND image != ''")
+    for (product_id,) in c.fetchall():
+        c.execute('SELECT image FROM products WHERE id = ?', (product_id,))
+        data = decode_inline_image(c.fetchone()[0])
+        if data is not None and len(data) <= MAX_IMAGE_BYTES:
+            c.execute('UPDATE products SET image = NULL, image_hash = ? WHERE id = ?',
+                      (store_image(data), product_id))
+
+def create_user_chats(c):
+    """Create the per-user index of active chats with unread counts, kept up to date by the app"""
+    # One row per participant of each active chat; rows are removed when the chat ends
+    c.execute('''CREATE TABLE IF NOT EXISTS user_chats
+                (username TEXT NOT NULL,
+                 chat_id INTEGER NOT NULL,
+                 other_user TEXT NOT NULL,
+                 unread_count INTEGER NOT NULL DEFAULT 0,
+                 last_read_id INTEGER NOT NULL DEFAULT 0,
+                 last_message_id INTEGER,
+                 PRIMARY KEY (username, chat_id),
+                 FOREIGN KEY (username) REFERENCES users(username),
+                 FOREIGN KEY (chat_id) REFERENCES chats(id)) WITHOUT ROWID''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_user_chats_chat_id ON user_chats (chat_id)')
+    # Existing chats start with everything read
+    for user, other_user in (('user1', 'user2'), ('user2', 'user1')):
+        c.execute(f'''INSERT OR IGNORE INTO user_chats (username, chat_id, other_user, last_read_id, last_message_id)
+                      SELECT {user}, id, {other_user},
+                             COALESCE((SELECT MAX(messages.id) FROM messages WHERE messages.chat_id = chats.id), 0),
+                             (SELECT MAX(messages.id) FROM messages WHERE messages.chat_id = chats.id)
+                      FROM chats WHERE status = 'active\'''')
+
+def add_logged_out_at(c):
+    """Record when each user last logged out, so buffered visits from before it don't count"""
+    if 'logged_out_at' not in column_names(c, 'users'):
+        c.execute('ALTER TABLE users ADD COLUMN logged_out_at TIMESTAMP')
+
+# Applied in order; a database's PRAGMA user_version is the number already applied.
+# Only ever append to this list.
+MIGRATIONS = [
+    create_base_tables,
+    add_rating_aggregates,
+    add_price_usd,
+    create_products_fts,
+    create_lookup_indexes,
+    create_facet_indexes,
+    create_message_archive,
+    move_inline_images,
+    create_user_chats,
+    add_logged_out_at,
+]
+
+def migrate(database=DATABASE):
+    conn = sqlite3.connect(database, isolation_level=None)
+    c = conn.cursor()
+    c.execute('PRAGMA user_version')
+    version = c.fetchone()[0]
+
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        # Each migration and its version bump commit together
+        c.execute('BEGIN')
+        try:
+            migration(c)
+            c.execute(f'PRAGMA user_version = {number}')
+            c.execute('COMMIT')
+        except sqlite3.Error:
+            c.execute('ROLLBACK')
+            conn.close()
+            raise
+        print(f"[DB] Applied migration {number}: {migration.__doc__}.")
+
+    if version >= len(MIGRATIONS):
+        print(f"[DB] Database schema is up to date (version {version}).")
+    conn.close()
+
+def check_query_plans(database=DATABASE):
+    # Report any hot query whose plan scans a whole table instead of using an index. The
+    # queries come from app.py itself (which imports this module), so they can't drift apart.
+    from app import checked_queries
+    queries = checked_queries()
+    conn = sqlite3.connect(database)
+    c = conn.cursor()
+    full_scans = []
+    for query, params in queries:
+        c.execute('EXPLAIN QUERY PLAN ' + query, params)
+        for row in c.fetchall():
+            detail = row[3]
+            # A SELECT of scalar subqueries "scans" its one constant row, which is free
+            if detail.startswith('SCAN ') and 'VIRTUAL TABLE' not in detail and detail != 'SCAN CONSTANT ROW':
+                full_scans.append((' '.join(query.split()), detail))
+    conn.close()
+
+    for query, detail in full_scans:
+        print(f"Full scan: {detail}\n    {query}")
+    if not full_scans:
+        print(f"All {len(queries)} checked queries use an index.")
+    return not full_scans
+
+if __name__ == "__main__":
+    if not os.path.exists(DATABASE):
+        print(f"[DB] Creating '{DATABASE}'.")
+    migrate()
+    if '--check' in sys.argv:
+        sys.exit(0 if check_query_plans() else 1)
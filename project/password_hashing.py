@@ -0,0 +1,96 @@
+# password_hashing.py
+
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# werkzeug's method string, written out in full as it is stored in front of each hash
+DEFAULT_METHOD = 'scrypt:32768:8:1'
+
+class HashingBusy(Exception):
+    """Raised when the hashing pool has too much queued work to take on more."""
+
+def hash_password(password, method):
+    return generate_password_hash(password, method)
+
+def verify_password(stored_hash, password, method):
+    # Returns (matches, new hash or None); a matching hash made with another method is replaced
+    if not check_password_hash(stored_hash, password):
+        return False, None
+    if hash_method(stored_hash) != method:
+        return True, generate_password_hash(password, method)
+    return True, None
+
+def hash_method(stored_hash):
+    return stored_hash.split('$', 1)[0]
+
+class PasswordHasher:
+    """Runs password hashing in a pool of processes so it doesn't hold up request threads.
+
+    At most max_pending hashes are queued or running; past that, calls raise HashingBusy
+    straight away instead of waiting. The pool starts on first use, so a process forked
+    before then (see serve.py) gets its own. Workers are spawned, not forked, so a script
+    that hashes passwords needs the usual `if __name__ == "__main__":` guard.
+    """
+
+    def __init__(self, method=DEFAULT_METHOD, workers=None, max_pending=None, timeout=10):
+        self.method = method
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending or self.workers * 4
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pid = None
+        self._slots = None
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                # Not fork: the request threads of this process must not be copied into the workers
+                self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+                self._pid = os.getpid()
+                self._slots = threading.BoundedSemaphore(self.max_pending)
+            return self._pool, self._slots
+
+    def _run(self, fn, *args):
+        pool, slots = self._executor()
+        if not slots.acquire(blocking=False):
+            raise HashingBusy()
+        try:
+            future = pool.submit(fn, *args)
+        except BrokenProcessPool:
+            slots.release()
+            self._reset(pool)
+            raise HashingBusy()
+        future.add_done_callback(lambda _: slots.release())
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            raise HashingBusy()
+        except BrokenProcessPool:
+            # A worker died; start a fresh pool for the next caller
+            self._reset(pool)
+            raise HashingBusy()
+
+    def _reset(self, pool):
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def hash(self, password):
+        return self._run(hash_password, password, self.method)
+
+    def verify(self, stored_hash, password):
+        # Returns (matches, new hash or None); store the new hash when there is one
+        return self._run(verify_password, stored_hash, password, self.method)
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None and self._pid == os.getpid():
+            pool.shutdown(wait=True, cancel_futures=True)
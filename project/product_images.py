@@ -0,0 +1,136 @@
+# product_images.py
+
+import base64
+import binascii
+import hashlib
+import io
+import os
+import queue
+import re
+import tempfile
+import threading
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Thumbnails need Pillow; without it pages show the original image
+    Image = ImageOps = None
+
+IMAGE_DIR = 'product_images'  # Originals and thumbnails, named by the SHA-256 of the original
+MAX_IMAGE_BYTES = 5 * 1024 * 1024
+THUMBNAIL_SIZE = (320, 320)  # Every thumbnail is cropped to exactly this size
+THUMBNAIL_QUALITY = 85
+HASH_PATTERN = re.compile(r'[0-9a-f]{64}')
+DATA_URI_PATTERN = re.compile(r'data:image/[\w.+-]+;base64,', re.IGNORECASE)
+
+# Leading bytes of each accepted format and the type it is served as
+IMAGE_SIGNATURES = [
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+]
+
+class InvalidImage(ValueError):
+    """Raised for uploads that are too large or not an accepted image format."""
+
+def image_type(data):
+    # MIME type from the file's leading bytes, or None if it isn't an accepted image
+    for signature, mimetype in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return mimetype
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+def original_path(image_hash, image_dir=IMAGE_DIR):
+    # Two-character subdirectories keep any one directory from growing huge
+    return os.path.join(image_dir, 'originals', image_hash[:2], image_hash)
+
+def thumbnail_path(image_hash, image_dir=IMAGE_DIR):
+    return os.path.join(image_dir, 'thumbnails', image_hash[:2], image_hash + '.jpg')
+
+def write_atomically(path, data):
+    # Readers and other workers see either no file or the whole file
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.upload-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except OSError:
+        os.unlink(temp_path)
+        raise
+
+def store_image(data, image_dir=IMAGE_DIR):
+    """Save an image under the SHA-256 of its bytes and return the hash."""
+    if len(data) > MAX_IMAGE_BYTES:
+        raise InvalidImage(f"Images can be at most {MAX_IMAGE_BYTES // (1024 * 1024)} MB.")
+    if image_type(data) is None:
+        raise InvalidImage("Images must be JPEG, PNG, GIF or WebP files.")
+    image_hash = hashlib.sha256(data).hexdigest()
+    path = original_path(image_hash, image_dir)
+    # The same bytes always get the same name, so a repeated upload is stored once
+    if not os.path.exists(path):
+        write_atomically(path, data)
+    return image_hash
+
+def decode_inline_image(value):
+    # Image bytes from a data URI or bare base64 string, or None for anything else (e.g. a URL)
+    value = DATA_URI_PATTERN.sub('', value.strip(), count=1)
+    try:
+        data = base64.b64decode(value, validate=True)
+    except (binascii.Error, ValueError):
+        return None
+    return data if image_type(data) else None
+
+def make_thumbnail(image_hash, image_dir=IMAGE_DIR):
+    with Image.open(original_path(image_hash, image_dir)) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode in ('RGBA', 'LA', 'P'):
+            # JPEG has no transparency; put transparent images on white
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, 'white')
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
+        thumbnail = ImageOps.fit(image.convert('RGB'), THUMBNAIL_SIZE, Image.LANCZOS)
+    buffer = io.BytesIO()
+    thumbnail.save(buffer, 'JPEG', quality=THUMBNAIL_QUALITY, optimize=True)
+    write_atomically(thumbnail_path(image_hash, image_dir), buffer.getvalue())
+
+class ThumbnailWorker:
+    """Makes thumbnails of stored images on a background thread."""
+
+    def __init__(self, image_dir=IMAGE_DIR):
+        self.image_dir = image_dir
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._failed = set()  # Not retried on every request for them
+        self._worker = None
+
+    def schedule(self, image_hash):
+        if Image is None:
+            return
+        with self._lock:
+            if image_hash in self._pending or image_hash in self._failed:
+                return
+            self._pending.add(image_hash)
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name='thumbnail-worker', daemon=True)
+                self._worker.start()
+        self._queue.put(image_hash)
+
+    def _run(self):
+        while True:
+            image_hash = self._queue.get()
+            try:
+                if not os.path.exists(thumbnail_path(image_hash, self.image_dir)):
+                    make_thumbnail(image_hash, self.image_dir)
+            except (OSError, ValueError, Image.DecompressionBombError) as e:
+                print(f"[Images] Could not make a thumbnail of {image_hash}: {e}")
+                with self._lock:
+                    self._failed.add(image_hash)
+            finally:
+                with self._lock:
+                    self._pending.discard(image_hash)
@@ -0,0 +1,32 @@
+# rebuild_rating_aggregates.py
+
+import sqlite3
+import os
+from migrations import migrate
+
+DATABASE = 'auboutique.db'  # Ensure this path matches your project's database path
+
+def rebuild_rating_aggregates():
+    # Make sure the aggregate columns exist before filling them
+    migrate(DATABASE)
+
+    conn = sqlite3.connect(DATABASE)
+    c = conn.cursor()
+
+    # Recompute every product's aggregate from the ratings table in one pass
+    c.execute('''
+        UPDATE products SET
+            rating_count = COALESCE((SELECT COUNT(*) FROM ratings WHERE ratings.product_id = products.id), 0),
+            rating_sum = COALESCE((SELECT SUM(rating) FROM ratings WHERE ratings.product_id = products.id), 0)
+    ''')
+    updated = c.rowcount
+
+    conn.commit()
+    conn.close()
+    print(f"Rebuilt rating aggregates for {updated} products.")
+
+if __name__ == "__main__":
+    if os.path.exists(DATABASE):
+        rebuild_rating_aggregates()
+    else:
+        print(f"Database '{DATABASE}' does not exist. Please run the main application to create the database first.")
@@ -0,0 +1,225 @@
+# seed_data.py
+
+import argparse
+import math
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+from werkzeug.security import generate_password_hash
+
+import app as auboutique
+from migrations import migrate
+
+DATABASE = 'auboutique.db'  # Ensure this path matches your project's database path
+BATCH_SIZE = 10000  # Rows inserted per transaction
+SEED_PASSWORD = 'password'  # Every seeded user logs in with this
+USERNAME_PREFIX = 'user'  # Seeded users are user0, user1, ...
+HISTORY_DAYS = 90  # Seeded activity is spread over this many days before now
+
+# category: (relative popularity, median price in USD, nouns)
+CATALOG = {
+    'electronics': (30, 120, ['Headphones', 'Speaker', 'Charger', 'Monitor', 'Keyboard', 'Camera', 'Tablet']),
+    'books': (20, 15, ['Novel', 'Textbook', 'Cookbook', 'Atlas', 'Notebook', 'Comic', 'Dictionary']),
+    'clothing': (18, 30, ['Jacket', 'Sweater', 'Scarf', 'Sneakers', 'Hoodie', 'Dress', 'Jeans']),
+    'furniture': (10, 150, ['Chair', 'Desk', 'Shelf', 'Sofa', 'Lamp', 'Table', 'Dresser']),
+    'sports': (8, 40, ['Racket', 'Football', 'Bicycle', 'Helmet', 'Yoga Mat', 'Dumbbells']),
+    'kitchen': (7, 25, ['Kettle', 'Blender', 'Pan', 'Mug', 'Knife Set', 'Toaster']),
+    'toys': (4, 20, ['Puzzle', 'Board Game', 'Lego Set', 'Kite', 'Plush Bear']),
+    'art': (3, 60, ['Canvas', 'Easel', 'Print', 'Sketchbook', 'Paint Set']),
+}
+ADJECTIVES = ['Vintage', 'Compact', 'Wireless', 'Handmade', 'Classic', 'Portable', 'Premium', 'Used',
+              'Lightweight', 'Ergonomic', 'Foldable', 'Retro', 'Modern', 'Rustic', 'Deluxe']
+CONDITIONS = ['Like new.', 'Barely used.', 'Some signs of wear.', 'Still in the box.', 'Works perfectly.']
+# Share of listings in each currency; prices are converted from the USD median
+CURRENCY_WEIGHTS = {'USD': 70, 'EUR': 15, 'GBP': 10, 'JPY': 5}
+RATING_WEIGHTS = {1: 5, 2: 7, 3: 15, 4: 33, 5: 40}
+SOLD_SHARE = 0.1
+ACTIVE_CHAT_SHARE = 0.3
+MESSAGE_WORDS = ['hi', 'hello', 'is', 'this', 'still', 'available', 'yes', 'no', 'price', 'deal', 'can',
+                 'you', 'ship', 'today', 'tomorrow', 'thanks', 'great', 'ok', 'lower', 'pick', 'up', 'cash']
+
+def zipf_cum_weights(n, exponent=1.1):
+    # Rank r gets weight 1 / r^exponent: a few sellers, products and chats get most of the activity
+    total = 0.0
+    cum_weights = []
+    for rank in range(1, n + 1):
+        total += 1 / rank ** exponent
+        cum_weights.append(total)
+    return cum_weights
+
+def batched(conn, sql, rows, batch_size=BATCH_SIZE):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            conn.executemany(sql, batch)
+            conn.commit()
+            batch.clear()
+    if batch:
+        conn.executemany(sql, batch)
+        conn.commit()
+
+def timestamp(moment):
+    return moment.strftime('%Y-%m-%d %H:%M:%S')
+
+def seed_users(conn, rng, count, now):
+    # Hashing is deliberately slow, so every seeded user shares one hash
+    password = generate_password_hash(SEED_PASSWORD, auboutique.PASSWORD_HASH_METHOD)
+    rows = ((f'{USERNAME_PREFIX}{i}', password, f'User {i}', f'{USERNAME_PREFIX}{i}@example.com',
+             timestamp(now - timedelta(seconds=rng.expovariate(1 / 86400))))
+            for i in range(count))
+    batched(conn, 'INSERT INTO users (username, password, name, email, last_active) VALUES (?, ?, ?, ?, ?)',
+            rows)
+    return [f'{USERNAME_PREFIX}{i}' for i in range(count)]
+
+def seed_products(conn, rng, count, usernames):
+    categories = list(CATALOG)
+    category_weights = [CATALOG[category][0] for category in categories]
+    currencies = list(CURRENCY_WEIGHTS)
+    currency_weights = list(CURRENCY_WEIGHTS.values())
+    seller_weights = zipf_cum_weights(len(usernames))
+    sellers = rng.sample(usernames, len(usernames))
+
+    def rows():
+        for _ in range(count):
+            category = rng.choices(categories, category_weights)[0]
+            _, median_usd, nouns = CATALOG[category]
+            currency = rng.choices(currencies, currency_weights)[0]
+            price_usd = round(median_usd * math.exp(rng.gauss(0, 0.8)), 2)
+            price = round(auboutique.convert_currency(price_usd, 'USD', currency), 2)
+            seller = rng.choices(sellers, cum_weights=seller_weights)[0]
+            sold = rng.random() < SOLD_SHARE
+            buyer = rng.choice(usernames) if sold else None
+            quantity = 0 if sold else min(1 + int(rng.expovariate(0.7)), 50)
+            name = f'{rng.choice(ADJECTIVES)} {rng.choice(nouns)}'
+            description = f'{name} in {category}. {rng.choice(CONDITIONS)}'
+            yield (name, description, price, currency, seller, buyer, int(sold), quantity, category,
+                   auboutique.convert_currency(price, currency, 'USD'))
+
+    first_id = (conn.execute('SELECT COALESCE(MAX(id), 0) FROM products').fetchone()[0]) + 1
+    batched(conn, '''INSERT INTO products
+                     (name, description, price, currency, seller, buyer, sold, quantity, category, price_usd)
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', rows())
+    return list(range(first_id, first_id + count))
+
+def seed_ratings(conn, rng, count, product_ids):
+    if not product_ids:
+        return
+    popularity = rng.sample(product_ids, len(product_ids))
+    product_weights = zipf_cum_weights(len(product_ids))
+    scores = list(RATING_WEIGHTS)
+    score_weights = list(RATING_WEIGHTS.values())
+    aggregates = {}
+
+    def rows():
+        for _ in range(count):
+            product_id = rng.choices(popularity, cum_weights=product_weights)[0]
+            rating = rng.choices(scores, score_weights)[0]
+            rating_count, rating_sum = aggregates.get(product_id, (0, 0))
+            aggregates[product_id] = (rating_count + 1, rating_sum + rating)
+            yield (product_id, rating)
+
+    batched(conn, 'INSERT INTO ratings (product_id, rating) VALUES (?, ?)', rows())
+    batched(conn, '''UPDATE products SET rating_count = rating_count + ?, rating_sum = rating_sum + ?
+                     WHERE id = ?''',
+            ((rating_count, rating_sum, product_id) for product_id, (rating_count, rating_sum) in aggregates.items()))
+
+def seed_chats(conn, rng, count, usernames):
+    if len(usernames) < 2:
+        return []
+    chats = []
+    first_id = (conn.execute('SELECT COALESCE(MAX(id), 0) FROM chats').fetchone()[0]) + 1
+    for chat_id in range(first_id, first_id + count):
+        user1, user2 = rng.sample(usernames, 2)
+        status = 'active' if rng.random() < ACTIVE_CHAT_SHARE else 'ended'
+        chats.append((chat_id, user1, user2, status))
+    batched(conn, 'INSERT INTO chats (id, user1, user2, status) VALUES (?, ?, ?, ?)', chats)
+    return chats
+
+def seed_messages(conn, rng, count, chats, now):
+    if not chats:
+        return
+    ordered_chats = rng.sample(chats, len(chats))
+    chat_weights = zipf_cum_weights(len(chats), exponent=0.8)
+    start = now - timedelta(days=HISTORY_DAYS)
+    step = HISTORY_DAYS * 86400 / max(count, 1)
+
+    def rows():
+        # Generated in time order, so message ids follow timestamps as they do in the app
+        for i in range(count):
+            chat_id, user1, user2, _ = rng.choices(ordered_chats, cum_weights=chat_weights)[0]
+            content = ' '.join(rng.choices(MESSAGE_WORDS, k=rng.randint(2, 12))).capitalize() + '.'
+            yield (chat_id, rng.choice((user1, user2)), content, timestamp(start + timedelta(seconds=i * step)))
+
+    batched(conn, 'INSERT INTO messages (chat_id, sender, content, timestamp) VALUES (?, ?, ?, ?)', rows())
+
+def seed_user_chats(conn, chats):
+    # Each participant's row for the active chats, with every seeded message already read
+    active = [(chat_id, user1, user2) for chat_id, user1, user2, status in chats if status == 'active']
+    if not active:
+        return
+    last_ids = dict(conn.execute('SELECT chat_id, MAX(id) FROM messages WHERE chat_id BETWEEN ? AND ? GROUP BY chat_id',
+                                 (chats[0][0], chats[-1][0])).fetchall())
+    rows = []
+    for chat_id, user1, user2 in active:
+        last_id = last_ids.get(chat_id)
+        rows.append((user1, chat_id, user2, last_id or 0, last_id))
+        rows.append((user2, chat_id, user1, last_id or 0, last_id))
+    batched(conn, '''INSERT INTO user_chats (username, chat_id, other_user, last_read_id, last_message_id)
+                     VALUES (?, ?, ?, ?, ?)''', rows)
+
+def seed_database(conn, users, products, ratings, chats, messages, seed):
+    # The same seed and counts always produce the same data, with times relative to now
+    rng = random.Random(seed)
+    now = datetime.utcnow().replace(microsecond=0)
+    counts = {}
+
+    started = time.perf_counter()
+    usernames = seed_users(conn, rng, users, now)
+    counts['users'] = len(usernames)
+    product_ids = seed_products(conn, rng, products, usernames) if usernames else []
+    counts['products'] = len(product_ids)
+    seed_ratings(conn, rng, ratings, product_ids)
+    counts['ratings'] = ratings if product_ids else 0
+    seeded_chats = seed_chats(conn, rng, chats, usernames)
+    counts['chats'] = len(seeded_chats)
+    seed_messages(conn, rng, messages, seeded_chats, now)
+    seed_user_chats(conn, seeded_chats)
+    counts['messages'] = messages if seeded_chats else 0
+
+    # Let the query planner see the new data distribution
+    conn.execute('ANALYZE')
+    conn.commit()
+    summary = ', '.join(f'{count} {table}' for table, count in counts.items())
+    print(f"Seeded {summary} in {time.perf_counter() - started:.1f}s.")
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description="Fill the database with synthetic users, products, ratings and chats.")
+    parser.add_argument('--database', default=DATABASE)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--products', type=int, default=20000)
+    parser.add_argument('--ratings', type=int, default=100000)
+    parser.add_argument('--chats', type=int, default=2000)
+    parser.add_argument('--messages', type=int, default=50000)
+    parser.add_argument('--seed', type=int, default=1, help="Random seed; the same seed gives the same data")
+    args = parser.parse_args()
+
+    migrate(args.database)
+    auboutique.DATABASE = args.database
+    conn = auboutique.connect_database()
+    conn.slow_query_seconds = None  # Batches of thousands of rows are slow by design
+    try:
+        if conn.execute('SELECT 1 FROM users WHERE username = ?', (f'{USERNAME_PREFIX}0',)).fetchone():
+            print(f"Database '{args.database}' already holds seeded users; seed a fresh database instead.")
+            return 1
+        seed_database(conn, args.users, args.products, args.ratings, args.chats, args.messages, args.seed)
+    finally:
+        conn.close()
+    print(f"Seeded users log in with the password '{SEED_PASSWORD}'.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
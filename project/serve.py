@@ -0,0 +1,132 @@
+# serve.py
+
+import argparse
+import os
+import signal
+import socket
+import sys
+import time
+
+import app as auboutique
+from password_hashing import PasswordHasher
+from shared_state import state_file
+
+DATABASE = 'auboutique.db'  # Ensure this path matches your project's database path
+LISTEN_BACKLOG = 2048
+RESTART_DELAY_SECONDS = 1  # Pause before replacing a worker that died
+WSGI_THREADS = True  # Each WSGI worker serves requests on a thread per connection
+# Open chat streams never finish by themselves: on shutdown an ASGI worker waits this long for
+# them, and the launcher kills any worker still running this long after asking it to stop
+GRACEFUL_SHUTDOWN_SECONDS = 5
+SHUTDOWN_KILL_SECONDS = 15
+
+def bind_socket(host, port):
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(LISTEN_BACKLOG)
+    sock.set_inheritable(True)
+    return sock
+
+def run_worker(sock, args):
+    # Runs in the forked child; every worker accepts from the same listening socket
+    if args.server == 'asgi':
+        import uvicorn
+        # lifespan off: migrations already ran in the launcher
+        config = uvicorn.Config('asgi:application', lifespan='off', log_level='info',
+                                timeout_graceful_shutdown=GRACEFUL_SHUTDOWN_SECONDS)
+        uvicorn.Server(config).run(sockets=[sock])
+    else:
+        from werkzeug.serving import make_server
+        host, port = sock.getsockname()[:2]
+        server = make_server(host, port, auboutique.app, threaded=WSGI_THREADS, fd=sock.fileno())
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        server.serve_forever()
+
+def spawn_worker(sock, args):
+    pid = os.fork()
+    if pid == 0:
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGALRM, signal.SIG_DFL)
+        try:
+            run_worker(sock, args)
+        finally:
+            # os._exit skips the app's atexit hooks, so commit queued chat messages and write
+            # buffered presence here
+            try:
+                auboutique.message_writer.drain(auboutique.MESSAGE_COMMIT_TIMEOUT_SECONDS)
+                auboutique.presence.flush()
+                auboutique.password_hasher.shutdown()
+            finally:
+                os._exit(0)
+    return pid
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve AUBoutique with one worker process per core.")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--server', choices=['wsgi', 'asgi'], default='wsgi',
+                        help="wsgi: Flask on werkzeug's threaded server; asgi: asgi.py on uvicorn")
+    parser.add_argument('--database', default=DATABASE)
+    args = parser.parse_args()
+
+    # Schema changes and the price_usd refresh happen once, here, before any worker opens the database
+    auboutique.DATABASE = args.database
+    auboutique.init_database()
+    # WAL is a property of the database file; switch it once rather than racing in every worker
+    auboutique.connect_database().close()
+    auboutique.enable_shared_state(state_file(args.database))
+    workers = max(1, args.workers)
+    if 'AUBOUTIQUE_PASSWORD_HASH_WORKERS' not in os.environ:
+        # Each worker starts its own hashing pool; together they use about one process per core
+        hash_workers = max(1, (os.cpu_count() or 1) // workers)
+        auboutique.password_hasher = PasswordHasher(auboutique.PASSWORD_HASH_METHOD, hash_workers,
+                                                    hash_workers * auboutique.PASSWORD_HASH_QUEUE_PER_WORKER,
+                                                    auboutique.PASSWORD_HASH_TIMEOUT_SECONDS)
+
+    sock = bind_socket(args.host, args.port)
+    workers = {spawn_worker(sock, args) for _ in range(workers)}
+    print(f"[Serve] {len(workers)} {args.server} workers listening on {args.host}:{args.port}")
+
+    stopping = False
+
+    def signal_workers(signum):
+        for pid in list(workers):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def stop(signum, frame):
+        nonlocal stopping
+        if not stopping:
+            signal.alarm(SHUTDOWN_KILL_SECONDS)
+        stopping = True
+        signal_workers(signal.SIGTERM)
+
+    def kill_stragglers(signum, frame):
+        print(f"[Serve] Workers still running after {SHUTDOWN_KILL_SECONDS}s; killing them.")
+        signal_workers(signal.SIGKILL)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGALRM, kill_stragglers)
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        workers.discard(pid)
+        if not stopping:
+            print(f"[Serve] Worker {pid} exited with status {status}; starting a replacement.")
+            time.sleep(RESTART_DELAY_SECONDS)
+            if not stopping:
+                workers.add(spawn_worker(sock, args))
+    sock.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
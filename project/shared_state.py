@@ -0,0 +1,72 @@
+# shared_state.py
+
+import fcntl
+import mmap
+import os
+import struct
+import threading
+
+# Counters shared by worker processes; each is a signed 64-bit slot in the state file
+COUNTERS = (
+    'listing',           # Marketplace catalog version
+    'listing_modified',  # Unix time the catalog last changed
+    'chats',             # Bumped whenever a chat's participants or status change
+    'chat_events',       # Bumped for every new message or ended chat
+    'wishlists',         # Bumped whenever a user's wishlist changes
+)
+SLOT = struct.Struct('q')
+
+def state_file(database):
+    # Counters the workers share, next to the database they describe
+    return os.path.splitext(database)[0] + '.state'
+
+class SharedCounters:
+    """Named counters in a memory-mapped file, so every worker process sees the same values.
+
+    Reads are a plain memory access; updates take a file lock so no increment is lost.
+    """
+
+    def __init__(self, path, names=COUNTERS):
+        self.path = path
+        self._offsets = {name: i * SLOT.size for i, name in enumerate(names)}
+        size = SLOT.size * len(names)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            # MAP_SHARED, so forked workers keep writing to the same pages
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self._lock = threading.Lock()
+        self._lock_fd = None
+        self._lock_pid = None
+
+    def get(self, name):
+        return SLOT.unpack_from(self._map, self._offsets[name])[0]
+
+    def bump(self, name):
+        return self._update(name, lambda value: value + 1)
+
+    def set(self, name, value):
+        return self._update(name, lambda _: value)
+
+    def _update(self, name, change):
+        offset = self._offsets[name]
+        with self._lock:
+            fd = self._process_lock_fd()
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                value = change(SLOT.unpack_from(self._map, offset)[0])
+                SLOT.pack_into(self._map, offset, value)
+                return value
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def _process_lock_fd(self):
+        # flock is held per open file, and a descriptor inherited across fork is the same
+        # open file, so every process opens its own
+        if self._lock_pid != os.getpid():
+            self._lock_fd = os.open(self.path, os.O_RDWR)
+            self._lock_pid = os.getpid()
+        return self._lock_fd